@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import dmAssist
+import generate_campaign
+from generate_campaign import SKILLS
+
+class PlainCharacter:
+    def __init__(self, name, race, char_class, level, sub_class, ability_modifiers, proficiencies, actions, god, proficiency_bonus, saving_throws):
+        self.name = name
+        self.race = race
+        self.char_class = char_class
+        self.level = level
+        self.sub_class = sub_class
+        self.ability_modifiers = ability_modifiers
+        self.proficiencies = [proficiency.lower() for proficiency in proficiencies]
+        self.actions = actions
+        self.god = god
+        self.proficiency_bonus = proficiency_bonus
+        self.saving_throws = [saving_throw.lower() for saving_throw in saving_throws]
+
+def decoded_characters(count):
+    # Round-tripping through JSON gives every record its own strings, as loading characters.json would
+    for data in generate_campaign.generate_characters({"characters": count, "gods": 100}):
+        yield json.loads(json.dumps(data))
+
+def campaign_counts(characters, gods):
+    return {"characters": characters, "gods": gods, "towns": 0, "shops": 0, "taverns": 0}
+
+def write_campaign(directory, characters, gods):
+    generate_campaign.generate_campaign(directory, campaign_counts(characters, gods))
+
+def use_campaign(directory):
+    dmAssist.registry = dmAssist.Registry(directory)
+    dmAssist.registry.load()
+
+def synthetic_commands(count, characters, gods, seed=0):
+    rng = random.Random(seed)
+    templates = [
+        lambda: f"character {rng.randrange(characters)} info",
+        lambda: f"god {rng.randrange(gods)} info",
+        lambda: f"check {rng.choice(SKILLS)} character {rng.randrange(characters)}",
+        lambda: f"god {rng.randrange(gods)} followers",
+        lambda: f"god of aspect {rng.randrange(gods * 2)}",
+        lambda: f"character {rng.randrange(characters)} {rng.choice(SKILLS)}",
+        lambda: f"{rng.choice(SKILLS)} check",
+    ]
+    return [rng.choice(templates)() for _ in range(count)]
+
+def build(cls, data):
+    return cls(
+        data["name"],
+        data["race"],
+        data["char_class"],
+        data["level"],
+        data["sub_class"],
+        data["ability_modifiers"],
+        data["proficiencies"],
+        data["actions"],
+        data["god"],
+        data["proficiency_bonus"],
+        data["saving_throws"]
+    )
+
+def resident_bytes():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def retained_bytes(cls, count):
+    # Resident set growth is cheap to read on Linux; tracemalloc is the portable (but much slower) fallback
+    if os.path.exists("/proc/self/statm"):
+        gc.collect()
+        before = resident_bytes()
+        objects = [build(cls, data) for data in decoded_characters(count)]
+        gc.collect()
+        return resident_bytes() - before
+    tracemalloc.start()
+    objects = [build(cls, data) for data in decoded_characters(count)]
+    total = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return total
+
+def run_memory(args):
+    print(f"Loading {args.count} synthetic characters")
+    for label, cls in [("before (plain classes, dict modifiers)", PlainCharacter), ("after (slots, array modifiers, interned)", dmAssist.Character)]:
+        # Each measurement runs in a fresh process so freed memory from the other run can't hide growth
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            total = executor.submit(retained_bytes, cls, args.count).result()
+        print(f"  {label}: {total / args.count:.0f} bytes per character ({total / 2 ** 20:.1f} MiB)")
+
+def run_batch(args):
+    with tempfile.TemporaryDirectory() as directory:
+        write_campaign(directory, args.characters, args.gods)
+        use_campaign(directory)
+        script = io.StringIO("\n".join(synthetic_commands(args.commands, args.characters, args.gods)) + "\n")
+        with open(os.devnull, "w") as output:
+            start = time.perf_counter()
+            commands = dmAssist.run_batch(script, output, as_json=args.json)
+            elapsed = time.perf_counter() - start
+    print(f"Ran {commands} commands against {args.characters} characters and {args.gods} gods in {elapsed:.2f} s: {commands / elapsed:.0f} commands per second")
+
+DISPATCH_SAMPLES = {
+    "exact": "all worships",
+    "prefix": "god of the northern wastes",
+    "suffix": "character 12 info",
+    "stat suffix": "character 12 sleight of hand",
+    "saving throw": "all strength st",
+    "wealth taverns": "port vale rich taverns",
+    "unknown": "this is not a command at all",
+}
+
+def run_dispatch(args):
+    router = dmAssist.router
+    print(f"Dispatch latency over {args.iterations} calls per command type")
+    for label, user_input in DISPATCH_SAMPLES.items():
+        uncached = timeit.timeit(lambda: router.match(user_input), number=args.iterations)
+        router.parse(user_input)
+        cached = timeit.timeit(lambda: router.parse(user_input), number=args.iterations)
+        print(f"  {label:<15} parse {uncached / args.iterations * 1e9:6.0f} ns, cached {cached / args.iterations * 1e9:6.0f} ns")
+
+def run_workers(args):
+    max_workers = args.max_workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as directory:
+        write_campaign(directory, args.characters, args.gods)
+        use_campaign(directory)
+        script = "\n".join(synthetic_commands(args.commands, args.characters, args.gods)) + "\n"
+        print(f"{args.commands} read commands against {args.characters} characters and {args.gods} gods")
+        baseline = None
+        for workers in range(0, max_workers + 1):
+            pool = dmAssist.ReadPool(workers) if workers else None
+            if pool is not None:
+                pool.publish()
+            try:
+                with open(os.devnull, "w") as output:
+                    start = time.perf_counter()
+                    dmAssist.run_batch(io.StringIO(script), output, pool=pool)
+                    elapsed = time.perf_counter() - start
+            finally:
+                if pool is not None:
+                    pool.close()
+            rate = args.commands / elapsed
+            baseline = baseline or rate
+            label = f"{workers} worker{'s' if workers != 1 else ''}" if workers else "in-process"
+            print(f"  {label:<12} {rate:8.0f} commands per second ({rate / baseline:.2f}x)")
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+async def wait_for_server(host, port, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def load_client(host, port, commands, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for user_input in commands:
+            start = time.perf_counter()
+            writer.write((json.dumps({"command": user_input}) + "\n").encode())
+            await writer.drain()
+            await reader.readline()
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+async def load_test(host, port, commands):
+    await wait_for_server(host, port)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(load_client(host, port, client_commands, latencies) for client_commands in commands))
+    return latencies, time.perf_counter() - start
+
+def run_server(args):
+    with tempfile.TemporaryDirectory() as directory:
+        write_campaign(directory, args.characters, args.gods)
+        server = subprocess.Popen([sys.executable, os.path.abspath(dmAssist.__file__), "--serve", f"127.0.0.1:{args.port}"], cwd=directory, stderr=subprocess.DEVNULL)
+        try:
+            commands = synthetic_commands(args.connections * args.requests, args.characters, args.gods)
+            per_client = [commands[i::args.connections] for i in range(args.connections)]
+            latencies, elapsed = asyncio.run(load_test("127.0.0.1", args.port, per_client))
+        finally:
+            server.terminate()
+            server.wait()
+    latencies.sort()
+    print(f"{len(latencies)} requests over {args.connections} concurrent connections in {elapsed:.2f} s ({len(latencies) / elapsed:.0f} requests per second)")
+    print(f"  p50 {percentile(latencies, 0.50) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+
+SUITE_COMMANDS = {
+    "info character": lambda rng, counts: f"character {rng.randrange(counts['characters'])} info",
+    "info tavern": lambda rng, counts: f"tavern {rng.randrange(counts['taverns'])} info",
+    "check": lambda rng, counts: f"check {rng.choice(SKILLS)} character {rng.randrange(counts['characters'])}",
+    "followers": lambda rng, counts: f"god {rng.randrange(counts['gods'])} followers",
+    "god of": lambda rng, counts: f"god of aspect {rng.randrange(counts['gods'] * 2)}",
+    "god search": lambda rng, counts: f"god search god {rng.randrange(counts['gods'])}",
+    "town shops": lambda rng, counts: f"town {rng.randrange(counts['towns'])} shops",
+    "town taverns": lambda rng, counts: f"town {rng.randrange(counts['towns'])} taverns",
+}
+
+def time_ms(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+def latency_summary(samples):
+    samples.sort()
+    return {
+        "calls": len(samples),
+        "mean_us": sum(samples) / len(samples) * 1e6,
+        "p50_us": percentile(samples, 0.50) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+    }
+
+def benchmark_scale(directory, counts, commands, seed):
+    generate_campaign.generate_campaign(directory, counts, seed)
+    registry = dmAssist.Registry(directory)
+    result = {"counts": counts, "load_ms": {}, "snapshot_load_ms": {}, "save_ms": {}, "commands": {}}
+    for kind, (filename, cls, label) in dmAssist.COLLECTIONS.items():
+        result["load_ms"][kind] = time_ms(registry.ensure_loaded, kind)
+        result["save_ms"][kind] = time_ms(dmAssist.save_to_file, registry.all(kind), os.path.join(directory, "saved-" + filename))
+        dmAssist.Registry(directory, snapshots=dmAssist.SnapshotCache()).ensure_loaded(kind)
+        result["snapshot_load_ms"][kind] = time_ms(dmAssist.Registry(directory, snapshots=dmAssist.SnapshotCache()).ensure_loaded, kind)
+    dmAssist.registry = registry
+    rng = random.Random(seed)
+    with open(os.devnull, "w") as output, contextlib.redirect_stdout(output):
+        for name, make_command in SUITE_COMMANDS.items():
+            samples = []
+            for _ in range(commands):
+                user_input = make_command(rng, counts)
+                start = time.perf_counter()
+                dmAssist.handle_command(user_input)
+                samples.append(time.perf_counter() - start)
+            result["commands"][name] = latency_summary(samples)
+    return result
+
+def run_suite(args):
+    report = {"python": platform.python_version(), "seed": args.seed, "commands_per_handler": args.commands, "scales": {}}
+    for scale in args.scales.split(","):
+        print(f"Benchmarking the {scale} campaign", file=sys.stderr)
+        with tempfile.TemporaryDirectory() as directory:
+            report["scales"][scale] = benchmark_scale(directory, generate_campaign.SCALES[scale], args.commands, args.seed)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+def timings(report):
+    for scale, result in report["scales"].items():
+        for section in ("load_ms", "snapshot_load_ms", "save_ms"):
+            for kind, value in result.get(section, {}).items():
+                yield f"{scale} {section[:-3]} {kind}", value
+        for name, summary in result["commands"].items():
+            yield f"{scale} {name} p50", summary["p50_us"]
+
+def run_compare(args):
+    with open(args.before) as file:
+        before = dict(timings(json.load(file)))
+    with open(args.after) as file:
+        after = dict(timings(json.load(file)))
+    regressions = 0
+    for name, value in after.items():
+        if name not in before or not before[name]:
+            continue
+        ratio = value / before[name]
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "  SLOWER"
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = "  faster"
+        print(f"  {name:<36} {before[name]:10.2f} -> {value:10.2f} ({ratio:.2f}x){flag}")
+    print(f"{regressions} regression{'s' if regressions != 1 else ''} over {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="DM Assist benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    memory = subparsers.add_parser("memory", help="bytes per entity for a synthetic campaign")
+    memory.add_argument("--count", type=int, default=1000000)
+    memory.set_defaults(run=run_memory)
+
+    batch = subparsers.add_parser("batch", help="commands per second through batch mode")
+    batch.add_argument("--commands", type=int, default=100000)
+    batch.add_argument("--characters", type=int, default=1000)
+    batch.add_argument("--gods", type=int, default=200)
+    batch.add_argument("--json", action="store_true")
+    batch.set_defaults(run=run_batch)
+
+    dispatch = subparsers.add_parser("dispatch", help="command router latency per command type")
+    dispatch.add_argument("--iterations", type=int, default=200000)
+    dispatch.set_defaults(run=run_dispatch)
+
+    server = subparsers.add_parser("server", help="latency percentiles against a local --serve process")
+    server.add_argument("--connections", type=int, default=1000)
+    server.add_argument("--requests", type=int, default=20, help="requests sent by each connection")
+    server.add_argument("--characters", type=int, default=1000)
+    server.add_argument("--gods", type=int, default=200)
+    server.add_argument("--port", type=int, default=8765)
+    server.set_defaults(run=run_server)
+
+    workers = subparsers.add_parser("workers", help="batch throughput from 1 to N worker processes")
+    workers.add_argument("--commands", type=int, default=100000)
+    workers.add_argument("--max-workers", type=int, default=0, help="defaults to the number of CPUs")
+    workers.add_argument("--characters", type=int, default=1000)
+    workers.add_argument("--gods", type=int, default=200)
+    workers.set_defaults(run=run_workers)
+
+    suite = subparsers.add_parser("suite", help="load (from JSON and from a snapshot), save and per-handler latency at each campaign scale, as JSON")
+    suite.add_argument("--scales", default="small,medium", help=f"comma separated, from {', '.join(generate_campaign.SCALES)}")
+    suite.add_argument("--commands", type=int, default=1000, help="commands timed per handler")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--output", metavar="FILE", help="write the report here instead of stdout")
+    suite.set_defaults(run=run_suite)
+
+    compare = subparsers.add_parser("compare", help="compare two suite reports and exit non-zero on regressions")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.add_argument("--threshold", type=float, default=0.1, help="relative change reported as slower or faster")
+    compare.set_defaults(run=run_compare)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
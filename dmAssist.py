@@ -1,53 +1,133 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import functools
+import heapq
+import hmac
+import io
 import json
+import math
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain
+
+STARTED_AT = time.perf_counter()
+
+ABILITIES = ["strength", "dexterity", "constitution", "intelligence", "wisdom", "charisma"]
+ABILITY_POSITIONS = {ability: i for i, ability in enumerate(ABILITIES)}
+
+SKILL_TO_ABILITY = {
+    "athletics": "strength",
+    "acrobatics": "dexterity",
+    "sleight of hand": "dexterity",
+    "stealth": "dexterity",
+    "arcana": "intelligence",
+    "history": "intelligence",
+    "investigation": "intelligence",
+    "nature": "intelligence",
+    "religion": "intelligence",
+    "animal handling": "wisdom",
+    "insight": "wisdom",
+    "medicine": "wisdom",
+    "perception": "wisdom",
+    "survival": "wisdom",
+    "deception": "charisma",
+    "intimidation": "charisma",
+    "performance": "charisma",
+    "persuasion": "charisma",
+    "social interaction": "charisma"
+}
+
+STAT_COLUMNS = ABILITIES + list(SKILL_TO_ABILITY) + [f"{ability} st" for ability in ABILITIES]
+STAT_POSITIONS = {stat: i for i, stat in enumerate(STAT_COLUMNS)}
+
+def intern_text(value):
+    return sys.intern(value) if type(value) is str else value
+
+class AbilityScores(MutableMapping):
+    __slots__ = ("values",)
+
+    def __init__(self, modifiers=()):
+        self.values = array("h", bytes(2 * len(ABILITIES)))
+        for ability, modifier in dict(modifiers).items():
+            # Files written by hand may capitalise abilities or carry extra keys, which a plain dict used to keep
+            if ability in self:
+                self[ability] = modifier
+            else:
+                print(f"Warning: ignoring unknown ability {ability}", file=sys.stderr)
+
+    def __getitem__(self, ability):
+        return self.values[ABILITY_POSITIONS[ability.casefold()]]
+
+    def __setitem__(self, ability, modifier):
+        if ability not in self:
+            raise KeyError(f"Unknown ability {ability}")
+        self.values[ABILITY_POSITIONS[ability.casefold()]] = int(modifier)
+
+    def __delitem__(self, ability):
+        raise KeyError(f"Ability {ability} cannot be removed")
+
+    def __contains__(self, ability):
+        return isinstance(ability, str) and ability.casefold() in ABILITY_POSITIONS
+
+    def __iter__(self):
+        return iter(ABILITIES)
+
+    def __len__(self):
+        return len(ABILITIES)
+
+    def __repr__(self):
+        return f"AbilityScores({dict(self)})"
 
 class Character:
+    __slots__ = ("name", "race", "char_class", "level", "sub_class", "ability_modifiers", "proficiencies", "actions", "god", "proficiency_bonus", "saving_throws")
+
     def __init__(self, name, race, char_class, level, sub_class, ability_modifiers, proficiencies, actions, god, proficiency_bonus, saving_throws):
         self.name = name
-        self.race = race
-        self.char_class = char_class
+        self.race = intern_text(race)
+        self.char_class = intern_text(char_class)
         self.level = level
-        self.sub_class = sub_class
-        self.ability_modifiers = ability_modifiers
-        self.proficiencies = [proficiency.lower() for proficiency in proficiencies]
+        self.sub_class = intern_text(sub_class)
+        self.ability_modifiers = AbilityScores(ability_modifiers)
+        self.proficiencies = [intern_text(proficiency.lower()) for proficiency in proficiencies]
         self.actions = actions
-        self.god = god
+        self.god = intern_text(god)
         self.proficiency_bonus = proficiency_bonus
-        self.saving_throws = [saving_throw.lower() for saving_throw in saving_throws]
+        self.saving_throws = [intern_text(saving_throw.lower()) for saving_throw in saving_throws]
 
     def get_stat(self, stat):
-        skill_to_ability = {
-            "athletics": "strength",
-            "acrobatics": "dexterity",
-            "sleight of hand": "dexterity",
-            "stealth": "dexterity",
-            "arcana": "intelligence",
-            "history": "intelligence",
-            "investigation": "intelligence",
-            "nature": "intelligence",
-            "religion": "intelligence",
-            "animal handling": "wisdom",
-            "insight": "wisdom",
-            "medicine": "wisdom",
-            "perception": "wisdom",
-            "survival": "wisdom",
-            "deception": "charisma",
-            "intimidation": "charisma",
-            "performance": "charisma",
-            "persuasion": "charisma",
-            "social interaction": "charisma"
-        }
-
         stat = stat.lower()
 
+        if stat.endswith(" st") and stat[:-3] in self.ability_modifiers:
+            stat = stat[:-3]
+            total_modifier = self.ability_modifiers[stat]
+            if stat in self.saving_throws:
+                total_modifier += self.proficiency_bonus
+            return total_modifier
+
         if stat in self.ability_modifiers:
             total_modifier = self.ability_modifiers[stat]
             if stat in self.saving_throws:
                 total_modifier += self.proficiency_bonus
             return total_modifier
 
-        ability = skill_to_ability.get(stat, None)
+        ability = SKILL_TO_ABILITY.get(stat, None)
         if not ability:
             return None
 
@@ -66,7 +146,7 @@ class Character:
             "char_class": self.char_class,
             "level": self.level,
             "sub_class": self.sub_class,
-            "ability_modifiers": self.ability_modifiers,
+            "ability_modifiers": dict(self.ability_modifiers),
             "proficiencies": self.proficiencies,
             "actions": self.actions,
             "god": self.god,
@@ -118,9 +198,11 @@ Proficiency Bonus: {self.proficiency_bonus}
         return info.strip()
 
 class God:
+    __slots__ = ("name", "patronage", "symbols", "notable_followers", "notes")
+
     def __init__(self, name, patronage, symbols, notable_followers, notes):
         self.name = name
-        self.patronage = patronage
+        self.patronage = [intern_text(aspect) for aspect in patronage]
         self.symbols = symbols
         self.notable_followers = notable_followers
         self.notes = notes
@@ -157,12 +239,14 @@ Notes: {self.notes}
         return info.strip()
 
 class Shop:
+    __slots__ = ("name", "town", "type", "shopkeep", "inventory")
+
     def __init__(self, name, town, type, shopkeep, inventory):
         self.name = name
-        self.town = town
-        self.type = type
+        self.town = intern_text(town)
+        self.type = intern_text(type)
         self.shopkeep = shopkeep
-        self.inventory = inventory
+        self.inventory = {intern_text(item): price for item, price in inventory.items()}
 
     def to_dict(self):
         return {
@@ -198,11 +282,13 @@ Inventory:
         return info.strip()
 
 class Town:
+    __slots__ = ("name", "mayor", "important_guilds", "patron_gods")
+
     def __init__(self, name, mayor, important_guilds, patron_gods):
         self.name = name
         self.mayor = mayor
-        self.important_guilds = important_guilds
-        self.patron_gods = patron_gods
+        self.important_guilds = [intern_text(guild) for guild in important_guilds]
+        self.patron_gods = [intern_text(god) for god in patron_gods]
 
     def to_dict(self):
         return {
@@ -233,9 +319,11 @@ Patron Gods: {', '.join(self.patron_gods)}
         return info.strip()
 
 class Shopkeep:
+    __slots__ = ("name", "town", "shop", "relationships", "notes")
+
     def __init__(self, name, town, shop, relationships, notes):
         self.name = name
-        self.town = town
+        self.town = intern_text(town)
         self.shop = shop
         self.relationships = relationships
         self.notes = notes
@@ -272,17 +360,19 @@ Notes: {self.notes}
         return info.strip()
 
 class Tavern:
+    __slots__ = ("name", "town", "barkeep", "menu", "accommodation", "wealth", "local_or_adventure", "lodging", "patrons", "guild_associations")
+
     def __init__(self, name, town, barkeep, menu, accommodation, wealth, local_or_adventure, lodging, patrons, guild_associations):
         self.name = name
-        self.town = town
+        self.town = intern_text(town)
         self.barkeep = barkeep
-        self.menu = menu
-        self.accommodation = accommodation
-        self.wealth = wealth
-        self.local_or_adventure = local_or_adventure
-        self.lodging = lodging
+        self.menu = {intern_text(item): price for item, price in menu.items()}
+        self.accommodation = {intern_text(type): price for type, price in accommodation.items()}
+        self.wealth = intern_text(wealth)
+        self.local_or_adventure = intern_text(local_or_adventure)
+        self.lodging = intern_text(lodging)
         self.patrons = patrons
-        self.guild_associations = guild_associations
+        self.guild_associations = [intern_text(guild) for guild in guild_associations]
 
     def to_dict(self):
         return {
@@ -334,77 +424,2015 @@ Guild Associations: {', '.join(self.guild_associations)}
         """
         return info.strip()
 
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def iter_json_array(file, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+
+    while True:
+        position = JSON_WHITESPACE.match(buffer, position).end()
+        if position < len(buffer):
+            break
+        if not read_more():
+            return
+    if buffer[position] != "[":
+        raise ValueError("Expected a JSON array")
+    position += 1
+
+    expect_comma = False
+    after_comma = False
+    while True:
+        position = JSON_WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            if not read_more():
+                raise ValueError("Unexpected end of JSON array")
+            continue
+        char = buffer[position]
+        if char == "]":
+            if after_comma:
+                raise ValueError("Trailing ',' before the end of the JSON array")
+            position += 1
+            break
+        if expect_comma:
+            if char != ",":
+                raise ValueError(f"Expected ',' between array elements, found {char!r}")
+            position += 1
+            expect_comma = False
+            after_comma = True
+            continue
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if not read_more():
+                raise
+            continue
+        # A number cut off by the chunk boundary (e.g. "12." or "1e") decodes early, so only accept an
+        # element once the ',' or ']' after it has been read
+        follow = JSON_WHITESPACE.match(buffer, end).end()
+        if not eof and (follow == len(buffer) or buffer[follow] not in ",]") and read_more():
+            continue
+        position = end
+        expect_comma = True
+        after_comma = False
+        yield item
+
+    while True:
+        position = JSON_WHITESPACE.match(buffer, position).end()
+        if position < len(buffer):
+            raise ValueError("Extra data after the end of the JSON array")
+        if not read_more():
+            return
+
+def fsync_directory(filename):
+    # Makes a file created, renamed or removed in the directory survive a crash (not possible, nor needed, on Windows)
+    if os.name == "nt":
+        return
+    descriptor = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
 def save_to_file(objects, filename):
-    with open(filename, "w") as file:
-        json.dump([obj.to_dict() for obj in objects], file)
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as file:
+        file.write("[")
+        for i, obj in enumerate(objects):
+            if i:
+                file.write(", ")
+            file.write(json.dumps(obj.to_dict()))
+        file.write("]")
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_filename, filename)
+    fsync_directory(filename)
+
+def iter_from_file(filename, cls):
+    with open(filename, "r") as file:
+        for item in iter_json_array(file):
+            yield cls.from_dict(item)
 
 def load_from_file(filename, cls):
     try:
-        with open(filename, "r") as file:
-            data = json.load(file)
-            return [cls.from_dict(item) for item in data]
+        return list(iter_from_file(filename, cls))
     except FileNotFoundError:
         return []
 
-# Load existing data
-characters = load_from_file("characters.json", Character)
-gods = load_from_file("gods.json", God)
-shops = load_from_file("shops.json", Shop)
-towns = load_from_file("towns.json", Town)
-shopkeeps = load_from_file("shopkeeps.json", Shopkeep)
-taverns = load_from_file("taverns.json", Tavern)
+def name_key(name):
+    return name.casefold()
+
+def entity_name_key(obj):
+    return name_key(obj.name)
+
+def character_god_keys(character):
+    return {name_key(character.god)} if character.god else set()
+
+def town_keys(obj):
+    return {name_key(obj.town)}
+
+def tavern_town_wealth_keys(tavern):
+    return {(name_key(tavern.town), name_key(tavern.wealth))}
+
+def character_stat_row(character):
+    return [character.get_stat(stat) for stat in STAT_COLUMNS]
+
+def shop_prices(shop):
+    return shop.inventory.items()
+
+def tavern_prices(tavern):
+    return list(tavern.menu.items()) + list(tavern.accommodation.items())
+
+def god_patronage_keys(god):
+    return {name_key(aspect) for aspect in god.patronage}
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Numeric tables rather than prose, so they stay out of full-text search
+TEXT_EXCLUDED = {"ability_modifiers", "actions"}
+
+def text_values(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        # Inventories, menus and accommodation are named by their keys
+        for item in value:
+            yield from text_values(item)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            yield from text_values(item)
+
+def entity_text(obj):
+    return [text for attr in obj.__slots__ if attr not in TEXT_EXCLUDED for text in text_values(getattr(obj, attr))]
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.casefold())
+
+# Each edge is (from, to, label read from -> to, label read to -> from)
+def character_edges(character):
+    return [(character.name, character.god, "worships", "worshipped by")]
+
+def god_edges(god):
+    return [(god.name, follower, "notable follower", "follows") for follower in god.notable_followers]
+
+def shop_edges(shop):
+    return [(shop.name, shop.shopkeep, "run by", "runs"), (shop.name, shop.town, "located in", "home of")]
+
+def town_edges(town):
+    return [
+        (town.name, town.mayor, "mayor", "mayor of"),
+        *[(town.name, guild, "guild", "guild in") for guild in town.important_guilds],
+        *[(town.name, god, "patron god", "patron god of") for god in town.patron_gods],
+    ]
+
+def shopkeep_edges(shopkeep):
+    return [
+        (shopkeep.name, shopkeep.shop, "runs", "run by"),
+        (shopkeep.name, shopkeep.town, "lives in", "home of"),
+        *[(shopkeep.name, other, "knows", "knows") for other in shopkeep.relationships],
+    ]
+
+def tavern_edges(tavern):
+    return [
+        (tavern.name, tavern.town, "located in", "home of"),
+        (tavern.name, tavern.barkeep, "barkeep", "barkeep at"),
+        *[(tavern.name, patron, "patron", "drinks at") for patron in tavern.patrons],
+        *[(tavern.name, guild, "associated guild", "associated with") for guild in tavern.guild_associations],
+    ]
+
+class UniqueIndex:
+    def __init__(self, key):
+        self.key = key
+        self.entries = {}
+
+    def add(self, obj):
+        key = self.key(obj)
+        if key in self.entries:
+            return False
+        self.entries[key] = obj
+        return True
+
+    def remove(self, obj):
+        key = self.key(obj)
+        if self.entries.get(key) is obj:
+            del self.entries[key]
+
+    def get(self, key):
+        return self.entries.get(key)
+
+class MultiIndex:
+    def __init__(self, keys):
+        self.keys = keys
+        self.entries = {}
+
+    def add(self, obj):
+        for key in self.keys(obj):
+            self.entries.setdefault(key, {})[obj] = None
+        return True
+
+    def remove(self, obj):
+        for key in self.keys(obj):
+            bucket = self.entries.get(key)
+            if bucket is not None:
+                bucket.pop(obj, None)
+                if not bucket:
+                    del self.entries[key]
+
+    def get(self, key):
+        return list(self.entries.get(key, ()))
+
+class NgramIndex:
+    def __init__(self, key, n=3):
+        self.key = key
+        self.n = n
+        self.entries = {}
+
+    def grams(self, text):
+        grams = set()
+        for size in range(1, self.n + 1):
+            for i in range(len(text) - size + 1):
+                grams.add(text[i:i + size])
+        return grams
+
+    def add(self, obj):
+        for gram in self.grams(self.key(obj)):
+            self.entries.setdefault(gram, {})[obj] = None
+        return True
+
+    def remove(self, obj):
+        for gram in self.grams(self.key(obj)):
+            bucket = self.entries.get(gram)
+            if bucket is not None:
+                bucket.pop(obj, None)
+                if not bucket:
+                    del self.entries[gram]
+
+    def get(self, fragment):
+        if not fragment:
+            return []
+        if len(fragment) <= self.n:
+            return list(self.entries.get(fragment, ()))
+        buckets = []
+        for i in range(len(fragment) - self.n + 1):
+            bucket = self.entries.get(fragment[i:i + self.n])
+            if not bucket:
+                return []
+            buckets.append(bucket)
+        buckets.sort(key=len)
+        return [obj for obj in buckets[0]
+                if all(obj in bucket for bucket in buckets[1:]) and fragment in self.key(obj)]
+
+class PartyStats:
+    def __init__(self, row):
+        self.row = row
+        self.characters = []
+        self.positions = {}
+        self.active = array("b")
+        self.columns = [array("i") for _ in STAT_COLUMNS]
+
+    def add(self, character):
+        # Rows are keyed by name rather than identity so a copy of the character (e.g. from SQLite) finds its row
+        values = self.row(character)
+        key = name_key(character.name)
+        position = self.positions.get(key)
+        if position is None:
+            self.positions[key] = len(self.characters)
+            self.characters.append(character)
+            self.active.append(1)
+            for column, value in zip(self.columns, values):
+                column.append(value)
+        else:
+            self.characters[position] = character
+            self.active[position] = 1
+            for column, value in zip(self.columns, values):
+                column[position] = value
+        return True
+
+    def remove(self, character):
+        position = self.positions.get(name_key(character.name))
+        if position is not None and self.characters[position] is character:
+            self.active[position] = 0
+
+    def get(self, character):
+        position = self.positions.get(name_key(character.name))
+        if position is None or not self.active[position]:
+            return None
+        return {stat: column[position] for stat, column in zip(STAT_COLUMNS, self.columns)}
+
+    def value(self, character, stat):
+        position = self.positions.get(name_key(character.name))
+        if position is None or not self.active[position]:
+            return None
+        return self.columns[STAT_POSITIONS[stat]][position]
+
+    def column(self, stat):
+        values = self.columns[STAT_POSITIONS[stat]]
+        active = self.active
+        return [(character, values[i]) for i, character in enumerate(self.characters) if active[i]]
+
+    def best(self, stat):
+        column = self.column(stat)
+        if not column:
+            return [], None
+        top = max(value for character, value in column)
+        return [character for character, value in column if value == top], top
+
+class TextIndex:
+    def __init__(self, texts):
+        self.texts = texts
+        self.postings = {}
+        self.lengths = {}
+        self.total_length = 0
+        self.terms = []
+
+    def counts(self, obj):
+        counts = {}
+        for text in self.texts(obj):
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0) + 1
+        return counts
+
+    def add(self, obj):
+        counts = self.counts(obj)
+        for term, count in counts.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                insort(self.terms, term)
+            posting[obj] = count
+        length = sum(counts.values())
+        self.lengths[obj] = length
+        self.total_length += length
+        return True
+
+    def add_many(self, objects):
+        for obj in objects:
+            counts = self.counts(obj)
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[obj] = count
+            length = sum(counts.values())
+            self.lengths[obj] = length
+            self.total_length += length
+        self.terms = sorted(self.postings)
+
+    def remove(self, obj):
+        length = self.lengths.pop(obj, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in self.counts(obj):
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(obj, None)
+                if not posting:
+                    del self.postings[term]
+                    del self.terms[bisect_left(self.terms, term)]
+
+    def get(self, term):
+        return self.postings.get(term, {})
+
+    def expand(self, prefix, limit):
+        # The terms are kept sorted, so every term starting with prefix is one contiguous run
+        start = bisect_left(self.terms, prefix)
+        end = start
+        while end < len(self.terms) and end - start < limit and self.terms[end].startswith(prefix):
+            end += 1
+        return self.terms[start:end]
+
+def directed_edges(edges, obj):
+    # Both directions of every edge as (from key, to key, label, from name), skipping blank ends and self-loops
+    for source, target, label, reverse_label in edges(obj):
+        if not source or not target:
+            continue
+        source_key, target_key = name_key(source), name_key(target)
+        if source_key != target_key:
+            yield source_key, target_key, label, source
+            yield target_key, source_key, reverse_label, target
+
+class EdgeIndex:
+    def __init__(self, edges):
+        self.edges = edges
+        self.adjacency = {}
+        self.names = {}
+
+    def keyed_edges(self, obj):
+        for source_key, target_key, label, source in directed_edges(self.edges, obj):
+            self.names.setdefault(source_key, source)
+            yield source_key, target_key, label
+
+    def add(self, obj):
+        # Most edges carry one label, kept as a bare string; repeated edges become a tuple of labels
+        for source, target, label in self.keyed_edges(obj):
+            neighbours = self.adjacency.setdefault(source, {})
+            labels = neighbours.get(target)
+            if labels is None:
+                neighbours[target] = label
+            else:
+                neighbours[target] = (labels if isinstance(labels, tuple) else (labels,)) + (label,)
+        return True
+
+    def remove(self, obj):
+        for source, target, label in self.keyed_edges(obj):
+            neighbours = self.adjacency.get(source)
+            labels = neighbours.get(target) if neighbours else None
+            if labels is None:
+                continue
+            labels = list(labels) if isinstance(labels, tuple) else [labels]
+            if label in labels:
+                labels.remove(label)
+                if len(labels) > 1:
+                    neighbours[target] = tuple(labels)
+                elif labels:
+                    neighbours[target] = labels[0]
+                else:
+                    del neighbours[target]
+                    if not neighbours:
+                        del self.adjacency[source]
+
+    def get(self, key):
+        return self.adjacency.get(key, {})
+
+    def labels(self, source, target):
+        labels = self.adjacency.get(source, {}).get(target, ())
+        return (labels,) if isinstance(labels, str) else labels
+
+def edit_distance(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+FUZZY_DELETIONS = 2
+FUZZY_SHORT_NAME = 7
+
+def trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def deletions(word, distance):
+    found = {word}
+    level = {word}
+    for _ in range(distance):
+        level = {variant[:i] + variant[i + 1:] for variant in level for i in range(len(variant))}
+        found |= level
+    return found
+
+class FuzzyIndex:
+    def __init__(self, key):
+        self.key = key
+        self.names = {}
+        # Trigram postings and the short-name deletions are only built on the first lookup that needs them,
+        # so loading a collection never pays for them
+        self.postings = None
+        self.deletions = None
+        self.lock = threading.Lock()
+
+    def short_deletions(self, word):
+        return deletions(word, FUZZY_DELETIONS) if len(word) <= FUZZY_SHORT_NAME else ()
+
+    def add(self, obj):
+        word = self.key(obj)
+        bucket = self.names.get(word)
+        if bucket is None:
+            bucket = self.names[word] = {}
+            if self.postings is not None:
+                for gram in trigrams(word):
+                    self.postings.setdefault(gram, set()).add(word)
+            if self.deletions is not None:
+                for variant in self.short_deletions(word):
+                    self.deletions.setdefault(variant, set()).add(word)
+        bucket[obj] = None
+        return True
+
+    def remove(self, obj):
+        word = self.key(obj)
+        bucket = self.names.get(word)
+        if bucket is not None:
+            bucket.pop(obj, None)
+            if not bucket:
+                del self.names[word]
+                if self.postings is not None:
+                    for gram in trigrams(word):
+                        self.postings[gram].discard(word)
+                if self.deletions is not None:
+                    for variant in self.short_deletions(word):
+                        self.deletions[variant].discard(word)
+
+    def build(self):
+        with self.lock:
+            if self.postings is None:
+                postings = {}
+                for word in self.names:
+                    for gram in trigrams(word):
+                        postings.setdefault(gram, set()).add(word)
+                self.postings = postings
+        return self.postings
+
+    def build_deletions(self):
+        with self.lock:
+            if self.deletions is None:
+                found = {}
+                for word in self.names:
+                    for variant in self.short_deletions(word):
+                        found.setdefault(variant, set()).add(word)
+                self.deletions = found
+        return self.deletions
+
+    def __getstate__(self):
+        return {"key": self.key, "names": self.names}
+
+    def __setstate__(self, state):
+        self.key = state["key"]
+        self.names = state["names"]
+        self.postings = None
+        self.deletions = None
+        self.lock = threading.Lock()
+
+    def get(self, word, max_distance=2):
+        grams = trigrams(word)
+        # An edit touches at most three trigrams, so a close name shares all but 3 * max_distance of them
+        needed = len(grams) - 3 * max_distance
+        if needed > 0:
+            postings = self.postings if self.postings is not None else self.build()
+            candidates = Counter(chain.from_iterable(postings.get(gram, ()) for gram in grams))
+        elif max_distance <= FUZZY_DELETIONS and len(word) + max_distance <= FUZZY_SHORT_NAME:
+            # Keys too short for trigrams to rule anything out: two words within max_distance edits
+            # always share a word left after deleting up to max_distance letters from each (SymSpell)
+            found = self.deletions if self.deletions is not None else self.build_deletions()
+            candidates = dict.fromkeys(chain.from_iterable(found.get(variant, ()) for variant in deletions(word, max_distance)), 0)
+        else:
+            # Only a long key made of repeated trigrams (e.g. "aaaaaaa") gets here
+            candidates = dict.fromkeys(self.names, 0)
+        matches = []
+        for candidate, count in candidates.items():
+            if count >= needed and abs(len(candidate) - len(word)) <= max_distance:
+                distance = edit_distance(word, candidate)
+                if distance <= max_distance:
+                    matches.extend((distance, obj) for obj in self.names[candidate])
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+def priced_items(prices, obj):
+    # Only real numbers are prices; anything else in an inventory or menu is left out of price queries
+    for item, price in prices(obj):
+        if not isinstance(price, bool) and isinstance(price, (int, float)):
+            yield item, price
+
+class PriceIndex:
+    def __init__(self, prices):
+        self.prices = prices
+        self.counter = 0
+        self.everything = []
+        self.by_item = {}
+        self.by_town = {}
+        self.entries = {}
+
+    def make_entries(self, obj):
+        town = name_key(obj.town)
+        entries = []
+        for item, price in priced_items(self.prices, obj):
+            self.counter += 1
+            entries.append((name_key(item), town, (price, self.counter, item, obj)))
+        self.entries[obj] = entries
+        return entries
+
+    def add(self, obj):
+        for item, town, entry in self.make_entries(obj):
+            insort(self.everything, entry)
+            insort(self.by_item.setdefault(item, []), entry)
+            insort(self.by_town.setdefault(town, []), entry)
+        return True
+
+    def add_many(self, objects):
+        for obj in objects:
+            for item, town, entry in self.make_entries(obj):
+                self.everything.append(entry)
+                self.by_item.setdefault(item, []).append(entry)
+                self.by_town.setdefault(town, []).append(entry)
+        for entries in [self.everything, *self.by_item.values(), *self.by_town.values()]:
+            entries.sort(key=lambda entry: entry[:2])
+
+    def remove(self, obj):
+        for item, town, entry in self.entries.pop(obj, ()):
+            for entries in (self.everything, self.by_item.get(item), self.by_town.get(town)):
+                if entries:
+                    i = bisect_left(entries, entry[:2])
+                    if i < len(entries) and entries[i] is entry:
+                        del entries[i]
+
+    def cheapest(self, item, limit, town=None):
+        found = []
+        for entry in self.by_item.get(item, ()):
+            if town is None or name_key(entry[3].town) == town:
+                found.append(entry)
+                if len(found) == limit:
+                    break
+        return found
+
+    def between(self, low, high, town=None, include_high=True):
+        entries = self.everything if town is None else self.by_town.get(town, [])
+        start = bisect_left(entries, (low,))
+        end = bisect_right(entries, (high, float("inf"))) if include_high else bisect_left(entries, (high,))
+        return entries[start:end]
+
+def render_card(obj):
+    return obj.display_info()
+
+class RenderCache:
+    def __init__(self, render, max_size=20000):
+        self.render = render
+        self.max_size = max_size
+        self.cards = {}
+        self.lock = threading.Lock()
+
+    def add(self, obj):
+        return True
+
+    def remove(self, obj):
+        with self.lock:
+            self.cards.pop(obj, None)
+
+    def get(self, obj):
+        card = self.cards.get(obj)
+        if card is None:
+            card = self.render(obj)
+            with self.lock:
+                if len(self.cards) >= self.max_size:
+                    del self.cards[next(iter(self.cards))]
+                self.cards[obj] = card
+        return card
+
+    def __getstate__(self):
+        # Snapshots start with an empty cache; cards are re-rendered on demand
+        return {"render": self.render, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["render"], state["max_size"])
+
+class JsonStorage:
+    def load(self, filename, cls):
+        return load_from_file(filename, cls)
+
+    def save(self, filename, objects, obj, key):
+        save_to_file(objects, filename)
+
+    def sources(self, filename):
+        return [filename]
+
+    def restored(self, filename):
+        pass
+
+    def flush(self, filename, objects):
+        pass
+
+class JournalStorage(JsonStorage):
+    def __init__(self, compact_after=500):
+        self.compact_after = compact_after
+        self.pending = {}
+
+    def journal_path(self, filename):
+        return filename + ".journal"
+
+    def read_journal(self, filename):
+        records = []
+        try:
+            with open(self.journal_path(filename), "r") as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def load(self, filename, cls):
+        objects = load_from_file(filename, cls)
+        positions = {}
+        for i, obj in enumerate(objects):
+            positions.setdefault(name_key(obj.name), i)
+        records = self.read_journal(filename)
+        for record in records:
+            obj = cls.from_dict(record["data"])
+            new_key = name_key(obj.name)
+            i = positions.pop(record["key"], None)
+            if i is None:
+                i = positions.get(new_key)
+            if i is None:
+                i = len(objects)
+                objects.append(obj)
+            else:
+                objects[i] = obj
+            positions[new_key] = i
+        self.pending[filename] = len(records)
+        if len(records) >= self.compact_after:
+            self.compact(filename, objects)
+        return objects
+
+    def save(self, filename, objects, obj, key):
+        record = {"op": "put", "key": key, "data": obj.to_dict()}
+        path = self.journal_path(filename)
+        created = not os.path.exists(path)
+        with open(path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        if created:
+            fsync_directory(path)
+        self.pending[filename] = self.pending.get(filename, 0) + 1
+        if self.pending[filename] >= self.compact_after:
+            self.compact(filename, objects)
+
+    def sources(self, filename):
+        return [filename, self.journal_path(filename)]
+
+    def restored(self, filename):
+        self.pending[filename] = len(self.read_journal(filename))
+
+    def flush(self, filename, objects):
+        if self.pending.get(filename):
+            self.compact(filename, objects)
+
+    def compact(self, filename, objects):
+        # save_to_file has made the new JSON durable before the journal holding the same records goes
+        save_to_file(objects, filename)
+        try:
+            os.remove(self.journal_path(filename))
+        except FileNotFoundError:
+            pass
+        self.pending[filename] = 0
+
+# Bump when an entity or index class changes what it stores, so old snapshots are rebuilt
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = b"DMASSIST SNAPSHOT %d\n" % SNAPSHOT_VERSION
+SNAPSHOT_DIGEST = "sha256"
+SNAPSHOT_DIGEST_SIZE = 32
+
+def file_signature(sources):
+    signature = []
+    for source in sources:
+        try:
+            stat = os.stat(source)
+            signature.append((os.path.basename(source), stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append((os.path.basename(source), None, None))
+    return signature
+
+def snapshot_key_path():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "dmassist", "snapshot.key")
+
+def read_or_create_key(path, size=32):
+    try:
+        with open(path, "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    try:
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Another session created it first
+        with open(path, "rb") as file:
+            return file.read()
+    key = os.urandom(size)
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(key)
+    return key
+
+class SnapshotCache:
+    def __init__(self, key_path=None):
+        self.key_path = key_path or os.environ.get("DMASSIST_SNAPSHOT_KEY") or snapshot_key_path()
+        self.key = None
+        self.lock = threading.Lock()
+
+    def path(self, filename):
+        return filename + ".snapshot"
+
+    def signature(self, sources):
+        return file_signature(sources)
+
+    def secret(self):
+        # Unpickling can run arbitrary code, so a snapshot is only trusted if it was signed with this user's private key
+        with self.lock:
+            if self.key is None:
+                try:
+                    self.key = read_or_create_key(self.key_path)
+                except OSError as e:
+                    print(f"Warning: snapshots are off, could not read or create {self.key_path}: {e}", file=sys.stderr)
+                    self.key = b""
+        return self.key
+
+    def load(self, filename, signature, index_names):
+        key = self.secret()
+        if not key:
+            return None
+        try:
+            with open(self.path(filename), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        start = len(SNAPSHOT_HEADER) + SNAPSHOT_DIGEST_SIZE
+        if not data.startswith(SNAPSHOT_HEADER):
+            return None
+        digest = hmac.new(key, memoryview(data)[start:], SNAPSHOT_DIGEST).digest()
+        if not hmac.compare_digest(digest, data[len(SNAPSHOT_HEADER):start]):
+            return None
+        stream = io.BytesIO(data)
+        stream.seek(start)
+        try:
+            unpickler = pickle.Unpickler(stream)
+            if unpickler.load() != {"sources": signature, "indexes": index_names}:
+                return None
+            return unpickler.load()
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, TypeError, ValueError):
+            return None
+
+    def save(self, filename, signature, index_names, objects, indexes, duplicates):
+        key = self.secret()
+        if not key:
+            return
+        payload = io.BytesIO()
+        pickler = pickle.Pickler(payload, pickle.HIGHEST_PROTOCOL)
+        pickler.dump({"sources": signature, "indexes": index_names})
+        pickler.dump((objects, indexes, duplicates))
+        payload = payload.getbuffer()
+        temp_filename = self.path(filename) + ".tmp"
+        try:
+            with open(temp_filename, "wb") as file:
+                file.write(SNAPSHOT_HEADER)
+                file.write(hmac.new(key, payload, SNAPSHOT_DIGEST).digest())
+                file.write(payload)
+            os.replace(temp_filename, self.path(filename))
+        except OSError as e:
+            print(f"Warning: could not write snapshot {self.path(filename)}: {e}", file=sys.stderr)
+
+STORAGES = {
+    "json": JsonStorage,
+    "journal": JournalStorage,
+}
+
+def make_storage(name):
+    if name not in STORAGES:
+        raise ValueError(f"Unknown storage mode {name}, expected one of {', '.join(STORAGES)}")
+    if name == "journal":
+        return JournalStorage(int(os.environ.get("DMASSIST_COMPACT_AFTER", 500)))
+    return STORAGES[name]()
+
+COLLECTIONS = {
+    "characters": ("characters.json", Character, "character"),
+    "gods": ("gods.json", God, "god"),
+    "shops": ("shops.json", Shop, "shop"),
+    "towns": ("towns.json", Town, "town"),
+    "shopkeeps": ("shopkeeps.json", Shopkeep, "shopkeep"),
+    "taverns": ("taverns.json", Tavern, "tavern"),
+}
+
+INDEXES = {
+    "characters": {
+        "followers": (MultiIndex, character_god_keys),
+        "stats": (PartyStats, character_stat_row),
+        "graph": (EdgeIndex, character_edges),
+    },
+    "gods": {
+        "patronage": (MultiIndex, god_patronage_keys),
+        "name_ngrams": (NgramIndex, entity_name_key),
+        "graph": (EdgeIndex, god_edges),
+    },
+    "shops": {
+        "town": (MultiIndex, town_keys),
+        "prices": (PriceIndex, shop_prices),
+        "graph": (EdgeIndex, shop_edges),
+    },
+    "towns": {
+        "graph": (EdgeIndex, town_edges),
+    },
+    "shopkeeps": {
+        "graph": (EdgeIndex, shopkeep_edges),
+    },
+    "taverns": {
+        "town": (MultiIndex, town_keys),
+        "town_wealth": (MultiIndex, tavern_town_wealth_keys),
+        "prices": (PriceIndex, tavern_prices),
+        "graph": (EdgeIndex, tavern_edges),
+    },
+}
+
+COMMON_INDEXES = {
+    "name": (UniqueIndex, entity_name_key),
+    "cards": (RenderCache, render_card),
+    "fuzzy": (FuzzyIndex, entity_name_key),
+    "text": (TextIndex, entity_text),
+}
+
+def index_specs(kind):
+    return {**COMMON_INDEXES, **INDEXES.get(kind, {})}
+
+WEALTH_LEVELS = {"poor", "average", "rich"}
+
+class Registry:
+    def __init__(self, directory=".", storage=None, snapshots=None):
+        self.directory = directory
+        self.storage = storage or JsonStorage()
+        self.snapshots = snapshots
+        self.watcher = None
+        self.dirty = set()
+        self.collections = {kind: [] for kind in COLLECTIONS}
+        self.indexes = {kind: self.make_indexes(kind) for kind in COLLECTIONS}
+        self.duplicates = {kind: [] for kind in COLLECTIONS}
+        self.loaded = set()
+        self.locks = {kind: threading.Lock() for kind in COLLECTIONS}
+
+    def make_indexes(self, kind):
+        return {index_name: index_cls(key) for index_name, (index_cls, key) in index_specs(kind).items()}
+
+    def path(self, kind):
+        return os.path.join(self.directory, COLLECTIONS[kind][0])
+
+    def load(self):
+        for kind in COLLECTIONS:
+            self.ensure_loaded(kind)
+
+    def ensure_loaded(self, kind):
+        if kind not in self.loaded:
+            with self.locks[kind]:
+                if kind not in self.loaded:
+                    self.load_collection(kind)
+                    self.loaded.add(kind)
+
+    def after_fork(self):
+        pass
+
+    def prefetch(self):
+        thread = threading.Thread(target=self.load, daemon=True)
+        thread.start()
+        return thread
+
+    def load_collection(self, kind):
+        filename, cls, label = COLLECTIONS[kind]
+        path = self.path(kind)
+        snapshot = None
+        if self.snapshots is not None:
+            sources = self.storage.sources(path)
+            signature = self.snapshots.signature(sources)
+            index_names = sorted(index_specs(kind))
+            snapshot = self.snapshots.load(path, signature, index_names)
+        if snapshot is not None:
+            objects, indexes, duplicates = snapshot
+            self.storage.restored(path)
+        else:
+            objects, indexes, duplicates = self.build_collection(kind, path)
+            # Skip the snapshot if the files changed while being read (e.g. a journal compaction)
+            if self.snapshots is not None and objects and self.snapshots.signature(sources) == signature:
+                self.snapshots.save(path, signature, index_names, objects, indexes, duplicates)
+        self.collections[kind] = objects
+        self.indexes[kind] = indexes
+        self.duplicates[kind] = duplicates
+        if duplicates:
+            print(f"Warning: duplicate {label} names in {filename}: {', '.join(duplicates)}", file=sys.stderr)
+
+    def build_collection(self, kind, path):
+        objects = self.storage.load(path, COLLECTIONS[kind][1])
+        indexes = self.make_indexes(kind)
+        unique = []
+        duplicates = []
+        for obj in objects:
+            if indexes["name"].add(obj):
+                unique.append(obj)
+            else:
+                duplicates.append(obj.name)
+        for index_name, index in indexes.items():
+            if index_name == "name":
+                continue
+            if hasattr(index, "add_many"):
+                index.add_many(unique)
+            else:
+                for obj in unique:
+                    index.add(obj)
+        return objects, indexes, duplicates
+
+    def all(self, kind):
+        self.ensure_loaded(kind)
+        return self.collections[kind]
+
+    def find(self, kind, name):
+        self.ensure_loaded(kind)
+        return self.indexes[kind]["name"].get(name_key(name))
+
+    def where(self, kind, index_name, *values):
+        self.ensure_loaded(kind)
+        key = tuple(name_key(value) for value in values) if len(values) > 1 else name_key(values[0])
+        return self.indexes[kind][index_name].get(key)
+
+    def index(self, kind, index_name):
+        self.ensure_loaded(kind)
+        return self.indexes[kind][index_name]
+
+    def render(self, kind, obj):
+        self.ensure_loaded(kind)
+        return self.indexes[kind]["cards"].get(obj)
+
+    def suggest(self, name, kinds=COLLECTIONS, limit=5):
+        key = name_key(name)
+        max_distance = 1 if len(key) <= 3 else 2
+        matches = []
+        for kind in kinds:
+            matches.extend(self.index(kind, "fuzzy").get(key, max_distance))
+        matches.sort(key=lambda match: match[0])
+        names = []
+        for distance, obj in matches:
+            if obj.name not in names:
+                names.append(obj.name)
+        return names[:limit]
+
+    def search(self, query, limit=10, kinds=COLLECTIONS):
+        # BM25 over every kind at once: document counts and lengths are pooled so scores compare across kinds
+        indexes = [(kind, self.index(kind, "text")) for kind in kinds]
+        documents = sum(len(index.lengths) for kind, index in indexes)
+        if not documents:
+            return []
+        average_length = sum(index.total_length for kind, index in indexes) / documents or 1
+        scores = {}
+        for query_term in dict.fromkeys(tokenize(query)):
+            terms = {query_term}
+            if len(query_term) >= SEARCH_PREFIX_MIN:
+                for kind, index in indexes:
+                    terms.update(index.expand(query_term, SEARCH_EXPANSIONS))
+            best = {}
+            for term in terms:
+                frequency = sum(len(index.get(term)) for kind, index in indexes)
+                if not frequency:
+                    continue
+                weight = term_weight(term, query_term, documents, frequency)
+                for kind, index in indexes:
+                    for obj, count in index.get(term).items():
+                        score = bm25(weight, count, index.lengths[obj], average_length)
+                        if score > best.get(obj, (0,))[0]:
+                            best[obj] = (score, kind)
+            for obj, (score, kind) in best.items():
+                total = scores.get(obj, (0, kind))[0] + score
+                scores[obj] = (total, kind)
+        return heapq.nlargest(limit, ((score, kind, obj) for obj, (score, kind) in scores.items()), key=lambda match: match[0])
+
+    def graphs(self):
+        return [self.index(kind, "graph") for kind in COLLECTIONS]
+
+    def graph_name(self, key, graphs):
+        for kind in COLLECTIONS:
+            found = self.find(kind, key)
+            if found is not None:
+                return found.name
+        for graph in graphs:
+            if key in graph.names:
+                return graph.names[key]
+        return key
+
+    def neighbours(self, name):
+        # The graph is split by the kind of record each edge came from, so merge the adjacency of every kind
+        graphs = self.graphs()
+        key = name_key(name)
+        found = {}
+        for graph in graphs:
+            for neighbour in graph.get(key):
+                for label in graph.labels(key, neighbour):
+                    if label not in found.setdefault(neighbour, []):
+                        found[neighbour].append(label)
+        return [(self.graph_name(neighbour, graphs), labels) for neighbour, labels in found.items()]
+
+    def shortest_path(self, start_name, goal_name, max_depth=6):
+        # Bidirectional breadth-first search, always growing the smaller frontier by one level
+        graphs = self.graphs()
+        start, goal = name_key(start_name), name_key(goal_name)
+        if start == goal:
+            return [(self.graph_name(start, graphs), None)]
+        forward, backward = {start: None}, {goal: None}
+        forward_frontier, backward_frontier = [start], [goal]
+        meeting = None
+        for depth in range(max_depth):
+            if not forward_frontier or not backward_frontier:
+                break
+            if len(forward_frontier) <= len(backward_frontier):
+                forward_frontier, meeting = expand_frontier(graphs, forward_frontier, forward, backward)
+            else:
+                backward_frontier, meeting = expand_frontier(graphs, backward_frontier, backward, forward)
+            if meeting is not None:
+                break
+        if meeting is None:
+            return None
+        path = []
+        key = meeting
+        while key is not None:
+            path.append(key)
+            key = forward[key]
+        path.reverse()
+        key = backward[meeting]
+        while key is not None:
+            path.append(key)
+            key = backward[key]
+        steps = []
+        for i, key in enumerate(path):
+            labels = None
+            if i + 1 < len(path):
+                labels = []
+                for graph in graphs:
+                    for label in graph.labels(key, path[i + 1]):
+                        if label not in labels:
+                            labels.append(label)
+            steps.append((self.graph_name(key, graphs), labels))
+        return steps
+
+    def followers(self, god_name, include_notable=False):
+        names = [char.name for char in self.where("characters", "followers", god_name)]
+        if include_notable:
+            god = self.find("gods", god_name)
+            if god is not None:
+                seen = {name_key(name) for name in names}
+                names.extend(follower for follower in god.notable_followers if follower and name_key(follower) not in seen)
+        return names
+
+    def save(self, kind, obj, key):
+        self.storage.save(self.path(kind), self.collections[kind], obj, key)
+        self.dirty.add(kind)
+        if self.watcher is not None:
+            self.watcher.saved(kind)
+
+    def close(self):
+        # Fold pending journals into the JSON and re-snapshot whatever changed, so reopening is a single read
+        for kind in sorted(self.dirty):
+            path = self.path(kind)
+            self.storage.flush(path, self.collections[kind])
+            if self.snapshots is not None:
+                signature = self.snapshots.signature(self.storage.sources(path))
+                self.snapshots.save(path, signature, sorted(index_specs(kind)), self.collections[kind], self.indexes[kind], self.duplicates[kind])
+        self.dirty.clear()
+
+    def add(self, kind, obj):
+        self.ensure_loaded(kind)
+        label = COLLECTIONS[kind][2]
+        if self.find(kind, obj.name) is not None:
+            raise ValueError(f"A {label} named {obj.name} already exists")
+        self.collections[kind].append(obj)
+        for index in self.indexes[kind].values():
+            index.add(obj)
+        self.save(kind, obj, name_key(obj.name))
+
+    def update(self, kind, obj, **changes):
+        self.ensure_loaded(kind)
+        label = COLLECTIONS[kind][2]
+        new_name = changes.get("name", obj.name)
+        existing = self.find(kind, new_name)
+        if existing is not None and existing is not obj:
+            raise ValueError(f"A {label} named {new_name} already exists")
+        old_key = name_key(obj.name)
+        self.patch(kind, obj, changes)
+        self.save(kind, obj, old_key)
+
+    def patch(self, kind, obj, changes):
+        indexes = self.indexes[kind].values()
+        for index in indexes:
+            index.remove(obj)
+        for attr, value in changes.items():
+            setattr(obj, attr, value)
+        for index in indexes:
+            index.add(obj)
+
+    def reload(self, kind):
+        # Re-read one file and patch only the records that differ, keeping the in-memory objects of the rest
+        if kind not in self.loaded:
+            return None
+        filename, cls, label = COLLECTIONS[kind]
+        with self.locks[kind]:
+            indexes = self.indexes[kind]
+            objects = []
+            duplicates = []
+            seen = set()
+            added = changed = 0
+            for obj in self.storage.load(self.path(kind), cls):
+                key = name_key(obj.name)
+                if key in seen:
+                    duplicates.append(obj.name)
+                    objects.append(obj)
+                    continue
+                seen.add(key)
+                existing = indexes["name"].get(key)
+                if existing is None:
+                    for index in indexes.values():
+                        index.add(obj)
+                    added += 1
+                else:
+                    if existing.to_dict() != obj.to_dict():
+                        self.patch(kind, existing, {attr: getattr(obj, attr) for attr in cls.__slots__})
+                        changed += 1
+                    obj = existing
+                objects.append(obj)
+            removed = [obj for obj in self.collections[kind] if name_key(obj.name) not in seen and indexes["name"].get(name_key(obj.name)) is obj]
+            for obj in removed:
+                for index in indexes.values():
+                    index.remove(obj)
+            self.collections[kind] = objects
+            self.duplicates[kind] = duplicates
+            if added or changed or removed:
+                self.dirty.add(kind)
+        if duplicates:
+            print(f"Warning: duplicate {label} names in {filename}: {', '.join(duplicates)}", file=sys.stderr)
+        return added, changed, len(removed)
+
+def expand_frontier(graphs, frontier, parents, other_parents):
+    next_frontier = []
+    for key in frontier:
+        for graph in graphs:
+            for neighbour in graph.get(key):
+                if neighbour not in parents:
+                    parents[neighbour] = key
+                    if neighbour in other_parents:
+                        return next_frontier, neighbour
+                    next_frontier.append(neighbour)
+    return next_frontier, None
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_PREFIX_MIN = 2
+SEARCH_PREFIX_WEIGHT = 0.5
+SEARCH_EXPANSIONS = 100
+
+def term_weight(term, query_term, documents, frequency):
+    idf = math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+    # A word that only starts with the query term counts for less than the word itself
+    return idf if term == query_term else idf * SEARCH_PREFIX_WEIGHT
+
+def bm25(weight, count, length, average_length):
+    length_norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+    return weight * count * (BM25_K1 + 1) / (count + length_norm)
+
+class FileWatcher:
+    def __init__(self, registry, interval=1.0):
+        self.registry = registry
+        self.interval = interval
+        self.signatures = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def signature(self, kind):
+        return file_signature(self.registry.storage.sources(self.registry.path(kind)))
+
+    def start(self):
+        self.registry.watcher = self
+        for kind in COLLECTIONS:
+            self.signatures[kind] = self.signature(kind)
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        for kind in COLLECTIONS:
+            signature = self.signature(kind)
+            with self.lock:
+                if signature != self.signatures[kind]:
+                    self.signatures[kind] = signature
+                    self.pending.add(kind)
+
+    def saved(self, kind):
+        # Our own writes don't need reloading
+        with self.lock:
+            self.signatures[kind] = self.signature(kind)
+            self.pending.discard(kind)
+
+    def apply(self):
+        # Called between commands, so no command ever sees a collection half patched
+        with self.lock:
+            kinds, self.pending = self.pending, set()
+        for kind in kinds:
+            counts = self.registry.reload(kind)
+            if counts is not None and any(counts):
+                added, changed, removed = counts
+                print(f"Reloaded {COLLECTIONS[kind][0]}: {added} added, {changed} changed, {removed} removed.", file=sys.stderr)
+
+SQL_COLUMNS = {
+    "characters": {"god_key": lambda character: name_key(character.god)},
+    "gods": {},
+    "shops": {"town_key": lambda shop: name_key(shop.town)},
+    "towns": {},
+    "shopkeeps": {"town_key": lambda shopkeep: name_key(shopkeep.town)},
+    "taverns": {
+        "town_key": lambda tavern: name_key(tavern.town),
+        "wealth_key": lambda tavern: name_key(tavern.wealth),
+    },
+}
+
+SQL_INDEXES = {
+    "characters": ["god_key"],
+    "shops": ["town_key"],
+    "shopkeeps": ["town_key"],
+    "taverns": ["town_key", "wealth_key", "town_key, wealth_key"],
+}
+
+SQL_WHERE = {
+    ("characters", "followers"): "god_key = ?",
+    ("gods", "patronage"): "id IN (SELECT god_id FROM god_patronage WHERE term = ?)",
+    ("gods", "name_ngrams"): "instr(name_key, ?) > 0",
+    ("shops", "town"): "town_key = ?",
+    ("taverns", "town"): "town_key = ?",
+    ("taverns", "town_wealth"): "town_key = ? AND wealth_key = ?",
+}
+
+# Bump when a derived table is added or changes, so connect() refills them from the stored records
+SQL_SCHEMA_VERSION = 3
+
+SQL_DERIVED_TABLES = [
+    "CREATE TABLE IF NOT EXISTS god_patronage (god_id INTEGER NOT NULL, term TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS god_patronage_term ON god_patronage (term)",
+    "CREATE INDEX IF NOT EXISTS god_patronage_god ON god_patronage (god_id)",
+    "CREATE TABLE IF NOT EXISTS search_documents (kind TEXT NOT NULL, row_id INTEGER NOT NULL, length INTEGER NOT NULL, PRIMARY KEY (kind, row_id))",
+    "CREATE TABLE IF NOT EXISTS search_terms (kind TEXT NOT NULL, row_id INTEGER NOT NULL, term TEXT NOT NULL, count INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS search_terms_term ON search_terms (kind, term)",
+    "CREATE INDEX IF NOT EXISTS search_terms_row ON search_terms (kind, row_id)",
+    "CREATE TABLE IF NOT EXISTS character_stats (character_id INTEGER NOT NULL, stat TEXT NOT NULL, value INTEGER, PRIMARY KEY (character_id, stat))",
+    "CREATE INDEX IF NOT EXISTS character_stats_value ON character_stats (stat, value)",
+    "CREATE TABLE IF NOT EXISTS links (kind TEXT NOT NULL, row_id INTEGER NOT NULL, source_key TEXT NOT NULL, target_key TEXT NOT NULL, label TEXT NOT NULL, source TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS links_source ON links (kind, source_key)",
+    "CREATE INDEX IF NOT EXISTS links_row ON links (kind, row_id)",
+    # price has no declared type so whole-number prices come back as ints, as they are in the JSON
+    "CREATE TABLE IF NOT EXISTS prices (kind TEXT NOT NULL, row_id INTEGER NOT NULL, item_key TEXT NOT NULL, town_key TEXT NOT NULL, item TEXT NOT NULL, price NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS prices_item ON prices (kind, item_key, price)",
+    "CREATE INDEX IF NOT EXISTS prices_price ON prices (kind, price)",
+    "CREATE INDEX IF NOT EXISTS prices_town ON prices (kind, town_key, price)",
+    "CREATE INDEX IF NOT EXISTS prices_row ON prices (kind, row_id)",
+]
+
+class SqlPartyStats:
+    # Answers the PartyStats queries from the character_stats table
+    def __init__(self, registry, kind="characters"):
+        self.registry = registry
+
+    def value(self, character, stat):
+        rows = self.registry.query("SELECT s.value FROM character_stats s JOIN characters c ON c.id = s.character_id WHERE c.name_key = ? AND s.stat = ?",
+            (name_key(character.name), stat))
+        return rows[0][0] if rows else None
+
+    def get(self, character):
+        rows = self.registry.query("SELECT s.stat, s.value FROM character_stats s JOIN characters c ON c.id = s.character_id WHERE c.name_key = ?",
+            (name_key(character.name),))
+        values = dict(rows)
+        return {stat: values[stat] for stat in STAT_COLUMNS} if values else None
+
+    def column(self, stat):
+        rows = self.registry.query("SELECT json_extract(c.data, '$.name'), s.value FROM character_stats s JOIN characters c ON c.id = s.character_id WHERE s.stat = ? ORDER BY c.id",
+            (stat,))
+        return [(RowName(name), value) for name, value in rows]
+
+    def best(self, stat):
+        rows = self.registry.query("SELECT json_extract(c.data, '$.name'), s.value FROM character_stats s JOIN characters c ON c.id = s.character_id "
+            "WHERE s.stat = ? AND s.value = (SELECT MAX(value) FROM character_stats WHERE stat = ?) ORDER BY c.id", (stat, stat))
+        if not rows:
+            return [], None
+        return [RowName(name) for name, value in rows], rows[0][1]
+
+class SqlNames:
+    # The display names of graph nodes, looked up in the links table on demand
+    def __init__(self, registry, kind):
+        self.registry = registry
+        self.kind = kind
+
+    def get(self, key, default=None):
+        rows = self.registry.query("SELECT source FROM links WHERE kind = ? AND source_key = ? ORDER BY rowid LIMIT 1", (self.kind, key))
+        return rows[0][0] if rows else default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        name = self.get(key)
+        if name is None:
+            raise KeyError(key)
+        return name
+
+class SqlEdgeIndex:
+    # Answers the EdgeIndex queries from the links table, one indexed lookup per node
+    def __init__(self, registry, kind):
+        self.registry = registry
+        self.kind = kind
+        self.names = SqlNames(registry, kind)
+
+    def get(self, key):
+        rows = self.registry.query("SELECT target_key FROM links WHERE kind = ? AND source_key = ? ORDER BY rowid", (self.kind, key))
+        return dict.fromkeys(target for (target,) in rows)
+
+    def labels(self, source, target):
+        rows = self.registry.query("SELECT label FROM links WHERE kind = ? AND source_key = ? AND target_key = ? ORDER BY rowid", (self.kind, source, target))
+        return tuple(label for (label,) in rows)
+
+class SqlPriceIndex:
+    # Answers the PriceIndex queries from the prices table, reading only the name and town of each seller
+    def __init__(self, registry, kind):
+        self.registry = registry
+        self.kind = kind
+
+    def entries(self, condition, values, limit=None):
+        rows = self.registry.query("SELECT p.price, p.rowid, p.item, json_extract(k.data, '$.name'), json_extract(k.data, '$.town') "
+            f"FROM prices p JOIN {self.kind} k ON k.id = p.row_id WHERE p.kind = ? AND {condition} ORDER BY p.price, p.rowid"
+            + (" LIMIT ?" if limit is not None else ""), (self.kind, *values) + ((limit,) if limit is not None else ()))
+        return [(price, counter, item, RowPlace(name, town)) for price, counter, item, name, town in rows]
+
+    def cheapest(self, item, limit, town=None):
+        if town is None:
+            return self.entries("p.item_key = ?", (item,), limit)
+        return self.entries("p.item_key = ? AND p.town_key = ?", (item, town), limit)
+
+    def between(self, low, high, town=None, include_high=True):
+        condition = "p.price >= ? AND p.price " + ("<= ?" if include_high else "< ?")
+        if town is None:
+            return self.entries(condition, (low, high))
+        return self.entries(condition + " AND p.town_key = ?", (low, high, town))
+
+SQL_INDEX_CLASSES = {
+    "stats": SqlPartyStats,
+    "graph": SqlEdgeIndex,
+    "prices": SqlPriceIndex,
+}
+
+class RowName:
+    # Stands in for a record when only its name was read from the database
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+class RowPlace(RowName):
+    __slots__ = ("town",)
+
+    def __init__(self, name, town):
+        super().__init__(name)
+        self.town = town
+
+class SqliteRegistry(Registry):
+    def __init__(self, database):
+        self.database = database
+        self.watcher = None
+        self.connection = None
+        self.duplicates = {kind: [] for kind in COLLECTIONS}
+        self.derived = {}
+        self.lock = threading.RLock()
+
+    def ensure_loaded(self, kind):
+        if self.connection is None:
+            with self.lock:
+                if self.connection is None:
+                    self.connect()
+
+    def load(self):
+        self.ensure_loaded(None)
+
+    def after_fork(self):
+        # A SQLite connection can't be shared with a forked child, so each worker opens its own
+        self.connection = None
+        self.derived = {}
+        self.lock = threading.RLock()
+
+    def connect(self):
+        self.connection = sqlite3.connect(self.database, check_same_thread=False)
+        for kind in COLLECTIONS:
+            columns = "".join(f", {column} TEXT" for column in SQL_COLUMNS[kind])
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {kind} (id INTEGER PRIMARY KEY, name_key TEXT NOT NULL UNIQUE, data TEXT NOT NULL{columns})")
+            for i, columns in enumerate(SQL_INDEXES.get(kind, [])):
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {kind}_index_{i} ON {kind} ({columns})")
+        for statement in SQL_DERIVED_TABLES:
+            self.connection.execute(statement)
+        self.connection.commit()
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        if version < SQL_SCHEMA_VERSION:
+            self.refill()
+
+    def refill(self):
+        # A database written by an older version lacks some derived rows, so rebuild them all once from the records
+        with self.connection:
+            for kind, (filename, cls, label) in COLLECTIONS.items():
+                for row_id, data in self.connection.execute(f"SELECT id, data FROM {kind}").fetchall():
+                    self.write_derived(kind, row_id, cls.from_dict(json.loads(data)))
+            self.connection.execute(f"PRAGMA user_version = {SQL_SCHEMA_VERSION}")
+
+    def query(self, sql, values=()):
+        self.ensure_loaded(None)
+        with self.lock:
+            return self.connection.execute(sql, values).fetchall()
+
+    def select(self, kind, condition="1", values=()):
+        cls = COLLECTIONS[kind][1]
+        with self.lock:
+            rows = self.connection.execute(f"SELECT data FROM {kind} WHERE {condition} ORDER BY id", values).fetchall()
+        return [cls.from_dict(json.loads(data)) for (data,) in rows]
+
+    def all(self, kind):
+        self.ensure_loaded(kind)
+        return self.select(kind)
+
+    def find(self, kind, name):
+        self.ensure_loaded(kind)
+        found = self.select(kind, "name_key = ?", (name_key(name),))
+        return found[0] if found else None
+
+    def where(self, kind, index_name, *values):
+        self.ensure_loaded(kind)
+        return self.select(kind, SQL_WHERE[(kind, index_name)], tuple(name_key(value) for value in values))
+
+    def render(self, kind, obj):
+        return obj.display_info()
+
+    def index(self, kind, index_name):
+        if index_name in SQL_INDEX_CLASSES:
+            return SQL_INDEX_CLASSES[index_name](self, kind)
+        # Indexes SQL can't answer are built on first use and dropped when the kind is written
+        with self.lock:
+            index = self.derived.get((kind, index_name))
+            if index is None:
+                index_cls, key = index_specs(kind)[index_name]
+                index = index_cls(key)
+                for obj in self.index_rows(kind, index_name):
+                    index.add(obj)
+                self.derived[(kind, index_name)] = index
+        return index
+
+    def index_rows(self, kind, index_name):
+        if index_name == "fuzzy":
+            # Suggestions only need the names, which SQLite pulls out of the JSON without decoding whole records
+            self.ensure_loaded(kind)
+            return [RowName(name) for (name,) in self.connection.execute(f"SELECT json_extract(data, '$.name') FROM {kind} ORDER BY id")]
+        return self.all(kind)
+
+    def invalidate(self, kind):
+        for index_kind, index_name in list(self.derived):
+            if index_kind == kind:
+                del self.derived[(index_kind, index_name)]
+
+    def write(self, kind, obj, key=None):
+        values = {"name_key": name_key(obj.name), "data": json.dumps(obj.to_dict())}
+        for column, value in SQL_COLUMNS[kind].items():
+            values[column] = value(obj)
+        try:
+            if key is None:
+                columns = ", ".join(values)
+                placeholders = ", ".join("?" for _ in values)
+                cursor = self.connection.execute(f"INSERT INTO {kind} ({columns}) VALUES ({placeholders})", tuple(values.values()))
+                row_id = cursor.lastrowid
+            else:
+                (row_id,) = self.connection.execute(f"SELECT id FROM {kind} WHERE name_key = ?", (key,)).fetchone()
+                assignments = ", ".join(f"{column} = ?" for column in values)
+                self.connection.execute(f"UPDATE {kind} SET {assignments} WHERE id = ?", tuple(values.values()) + (row_id,))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"A {COLLECTIONS[kind][2]} named {obj.name} already exists")
+        self.write_derived(kind, row_id, obj)
+
+    def write_derived(self, kind, row_id, obj):
+        # The rows the indexed queries read instead of decoding every record
+        if kind == "gods":
+            self.connection.execute("DELETE FROM god_patronage WHERE god_id = ?", (row_id,))
+            self.connection.executemany("INSERT INTO god_patronage (god_id, term) VALUES (?, ?)",
+                [(row_id, term) for term in god_patronage_keys(obj)])
+        counts = TextIndex(entity_text).counts(obj)
+        self.connection.execute("DELETE FROM search_terms WHERE kind = ? AND row_id = ?", (kind, row_id))
+        self.connection.executemany("INSERT INTO search_terms (kind, row_id, term, count) VALUES (?, ?, ?, ?)",
+            [(kind, row_id, term, count) for term, count in counts.items()])
+        self.connection.execute("INSERT OR REPLACE INTO search_documents (kind, row_id, length) VALUES (?, ?, ?)",
+            (kind, row_id, sum(counts.values())))
+        self.connection.execute("DELETE FROM links WHERE kind = ? AND row_id = ?", (kind, row_id))
+        self.connection.executemany("INSERT INTO links (kind, row_id, source_key, target_key, label, source) VALUES (?, ?, ?, ?, ?, ?)",
+            [(kind, row_id, *edge) for edge in directed_edges(index_specs(kind)["graph"][1], obj)])
+        if "prices" in index_specs(kind):
+            town = name_key(obj.town)
+            self.connection.execute("DELETE FROM prices WHERE kind = ? AND row_id = ?", (kind, row_id))
+            self.connection.executemany("INSERT INTO prices (kind, row_id, item_key, town_key, item, price) VALUES (?, ?, ?, ?, ?, ?)",
+                [(kind, row_id, name_key(item), town, item, price) for item, price in priced_items(index_specs(kind)["prices"][1], obj)])
+        if kind == "characters":
+            self.connection.execute("DELETE FROM character_stats WHERE character_id = ?", (row_id,))
+            self.connection.executemany("INSERT INTO character_stats (character_id, stat, value) VALUES (?, ?, ?)",
+                [(row_id, stat, value) for stat, value in zip(STAT_COLUMNS, character_stat_row(obj))])
+
+    def search(self, query, limit=10, kinds=COLLECTIONS):
+        # The same pooled BM25 as Registry.search, reading only the postings of the query's terms
+        kinds = tuple(kinds)
+        in_kinds = f"kind IN ({', '.join('?' for _ in kinds)})"
+        ((documents, total_length),) = self.query(f"SELECT COUNT(*), TOTAL(length) FROM search_documents WHERE {in_kinds}", kinds)
+        if not documents:
+            return []
+        average_length = total_length / documents or 1
+        scores = {}
+        for query_term in dict.fromkeys(tokenize(query)):
+            terms = {query_term}
+            if len(query_term) >= SEARCH_PREFIX_MIN:
+                for kind in kinds:
+                    terms.update(term for (term,) in self.query("SELECT DISTINCT term FROM search_terms WHERE kind = ? AND term >= ? AND term < ? ORDER BY term LIMIT ?",
+                        (kind, query_term, query_term + "\U0010ffff", SEARCH_EXPANSIONS)))
+            best = {}
+            for term in terms:
+                postings = self.query("SELECT t.kind, t.row_id, t.count, d.length FROM search_terms t JOIN search_documents d ON d.kind = t.kind AND d.row_id = t.row_id "
+                    f"WHERE t.{in_kinds} AND t.term = ?", kinds + (term,))
+                if not postings:
+                    continue
+                weight = term_weight(term, query_term, documents, len(postings))
+                for kind, row_id, count, length in postings:
+                    score = bm25(weight, count, length, average_length)
+                    if score > best.get((kind, row_id), 0):
+                        best[(kind, row_id)] = score
+            for document, score in best.items():
+                scores[document] = scores.get(document, 0) + score
+        top = heapq.nlargest(limit, scores.items(), key=lambda match: match[1])
+        return [(score, kind, self.select(kind, "id = ?", (row_id,))[0]) for (kind, row_id), score in top]
+
+    def add(self, kind, obj):
+        self.ensure_loaded(kind)
+        with self.lock, self.connection:
+            self.write(kind, obj)
+            self.invalidate(kind)
+
+    def update(self, kind, obj, **changes):
+        self.ensure_loaded(kind)
+        old_key = name_key(obj.name)
+        with self.lock, self.connection:
+            for attr, value in changes.items():
+                setattr(obj, attr, value)
+            self.write(kind, obj, old_key)
+            self.invalidate(kind)
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def import_from(self, source):
+        with self.connection:
+            for kind in COLLECTIONS:
+                for obj in source.all(kind):
+                    try:
+                        self.write(kind, obj)
+                    except ValueError as e:
+                        print(f"Skipping {obj.name}: {e}")
+                self.invalidate(kind)
+
+    def export_to(self, directory):
+        for kind, (filename, cls, label) in COLLECTIONS.items():
+            save_to_file(self.all(kind), os.path.join(directory, filename))
+
+def make_registry(directory=".", storage_name="json", database=None):
+    if storage_name == "sqlite":
+        return SqliteRegistry(database or os.environ.get("DMASSIST_DATABASE", os.path.join(directory, "dmassist.db")))
+    snapshots = SnapshotCache() if os.environ.get("DMASSIST_SNAPSHOT", "1") == "1" else None
+    return Registry(directory, make_storage(storage_name), snapshots)
+
+# Collections load on first use
+registry = make_registry(storage_name=os.environ.get("DMASSIST_STORAGE", "json"))
+
+current_campaign = contextvars.ContextVar("current_campaign", default=None)
+
+class Workspace:
+    def __init__(self, root, resident=4, storage_name="json", default=None, watch_interval=None):
+        self.root = root
+        self.resident = max(1, resident)
+        self.storage_name = storage_name
+        self.default = default
+        self.interval = watch_interval
+        self.registries = OrderedDict()
+        self.closing = {}
+        self.lock = threading.RLock()
+
+    def campaigns(self):
+        return sorted(entry.name for entry in os.scandir(self.root) if entry.is_dir() and not entry.name.startswith("."))
+
+    def resolve(self, name):
+        key = name_key(name.strip())
+        for campaign in self.campaigns():
+            if name_key(campaign) == key:
+                return campaign
+        raise ValueError(f"No campaign named {name}")
+
+    def default_campaign(self):
+        if self.default is None:
+            campaigns = self.campaigns()
+            if not campaigns:
+                os.makedirs(os.path.join(self.root, "default"), exist_ok=True)
+                campaigns = ["default"]
+            self.default = campaigns[0]
+        return self.default
+
+    def use(self, name):
+        campaign = self.resolve(name)
+        current_campaign.set(campaign)
+        self.get(campaign)
+        return campaign
+
+    def current(self):
+        return self.get(current_campaign.get() or self.default_campaign())
+
+    def get(self, campaign):
+        while True:
+            with self.lock:
+                registry = self.registries.get(campaign)
+                if registry is not None:
+                    self.registries.move_to_end(campaign)
+                    return registry
+                # A campaign that is still being written back can't be reopened until its files are settled
+                closing = self.closing.get(campaign)
+                if closing is None:
+                    directory = os.path.join(self.root, campaign)
+                    registry = make_registry(directory, self.storage_name, os.path.join(directory, "dmassist.db"))
+                    if self.interval and not isinstance(registry, SqliteRegistry):
+                        FileWatcher(registry, self.interval).start()
+                    self.registries[campaign] = registry
+                    evicted = []
+                    while len(self.registries) > self.resident:
+                        name, old = self.registries.popitem(last=False)
+                        self.closing[name] = threading.Event()
+                        evicted.append((name, old))
+                    break
+            closing.wait()
+        # Write-back happens outside the lock so the other campaigns keep answering meanwhile
+        for name, old in evicted:
+            try:
+                self.evict(old)
+            finally:
+                with self.lock:
+                    self.closing.pop(name).set()
+        return registry
+
+    def evict(self, registry):
+        if registry.watcher is not None:
+            registry.watcher.stop()
+        registry.close()
+
+    def close(self):
+        with self.lock:
+            while self.registries:
+                self.evict(self.registries.popitem(last=False)[1])
+
+    # The watchers of the resident campaigns, seen as one (see FileWatcher)
+    @property
+    def pending(self):
+        with self.lock:
+            return any(registry.watcher is not None and registry.watcher.pending for registry in self.registries.values())
+
+    def apply(self):
+        with self.lock:
+            for registry in self.registries.values():
+                if registry.watcher is not None:
+                    registry.watcher.apply()
+
+class CampaignRegistry:
+    # Stands in for the module-level registry, forwarding to the campaign selected in the current context
+    def __init__(self, workspace):
+        self.workspace = workspace
+
+    def __getattr__(self, attr):
+        return getattr(self.workspace.current(), attr)
+
+workspace = None
+
+def enable_workspace(root, resident=4, storage_name="json", default=None, watch_interval=None):
+    global workspace, registry
+    workspace = Workspace(root, resident, storage_name, default, watch_interval)
+    if default is not None:
+        workspace.default = workspace.resolve(default)
+    registry = CampaignRegistry(workspace)
+    return workspace
+
+interactive = contextvars.ContextVar("interactive", default=True)
+
+def ask(prompt):
+    # Batch scripts and server requests supply the answers up front, so their output shouldn't echo the prompts
+    if interactive.get():
+        return input(prompt)
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line.rstrip("\n")
+
+def handle_add_character_command():
+    try:
+        name = ask("Enter the name: ")
+        race = ask("Enter the race: ")
+        char_class = ask("Enter the class: ")
+        level = int(ask("Enter the level: "))
+        sub_class = ask("Enter the subclass: ")
+        ability_modifiers = {}
+        for ability in ABILITIES:
+            ability_modifiers[ability] = int(ask(f"Enter {ability} modifier: "))
+        proficiencies = ask("Enter proficiencies (comma separated): ").split(", ")
+        saving_throws = ask("Enter saving throws (comma separated): ").split(", ")
+        actions = {
+            "bonus_actions": ask("Enter bonus actions: "),
+            "extra_attacks": int(ask("Enter extra attacks: ")),
+            "actions": int(ask("Enter actions: "))
+        }
+        god = ask("Enter the god they worship: ")
+        proficiency_bonus = int(ask("Enter the proficiency bonus: "))
+
+        new_character = Character(name, race, char_class, level, sub_class, ability_modifiers, proficiencies, actions, god, proficiency_bonus, saving_throws)
+        registry.add("characters", new_character)
+        print(f"{name} has been added successfully.")
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+
+def handle_add_god_command():
+    try:
+        name = ask("Enter the name: ")
+        patronage = ask("Enter patronage (comma separated): ").split(", ")
+        symbols = ask("Enter symbols: ")
+        notable_followers = ask("Enter notable followers (comma separated): ").split(", ")
+        notes = ask("Enter notes: ")
+
+        new_god = God(name, patronage, symbols, set(notable_followers), notes)
+        registry.add("gods", new_god)
+        print(f"{name} has been added successfully.")
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+
+def handle_add_shop_command():
+    try:
+        name = ask("Enter the name: ")
+        town = ask("Enter the town where the shop is located: ")
+        type = ask("Enter the type of shop: ")
+        shopkeep = ask("Enter the name of the shopkeep: ")
+        inventory = {}
+        while True:
+            item = ask("Enter item name (or 'done' to finish): ")
+            if item.lower() == 'done':
+                break
+            price = float(ask(f"Enter price for {item}: "))
+            inventory[item] = price
+
+        new_shop = Shop(name, town, type, shopkeep, inventory)
+        registry.add("shops", new_shop)
+        print(f"{name} has been added successfully.")
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+
+def handle_add_town_command():
+    try:
+        name = ask("Enter the name: ")
+        mayor = ask("Enter the name of the mayor: ")
+        important_guilds = ask("Enter important guilds (comma separated): ").split(", ")
+        patron_gods = ask("Enter patron gods (comma separated): ").split(", ")
+
+        new_town = Town(name, mayor, important_guilds, patron_gods)
+        registry.add("towns", new_town)
+        print(f"{name} has been added successfully.")
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+
+def handle_add_shopkeep_command():
+    try:
+        name = ask("Enter the name: ")
+        town = ask("Enter the town where the shopkeep works: ")
+        shop = ask("Enter the name of their shop: ")
+        relationships = ask("Enter relationships (comma separated): ").split(", ")
+        notes = ask("Enter notes: ")
+
+        new_shopkeep = Shopkeep(name, town, shop, relationships, notes)
+        registry.add("shopkeeps", new_shopkeep)
+        print(f"{name} has been added successfully.")
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
 
 def handle_add_tavern_command():
     try:
-        name = input("Enter the name: ")
-        town = input("Enter the town where the tavern is located: ")
-        barkeep = input("Enter the name of the barkeep: ")
+        name = ask("Enter the name: ")
+        town = ask("Enter the town where the tavern is located: ")
+        barkeep = ask("Enter the name of the barkeep: ")
         menu = {}
         while True:
-            item = input("Enter menu item name (or 'done' to finish): ")
+            item = ask("Enter menu item name (or 'done' to finish): ")
             if item.lower() == 'done':
                 break
-            price = float(input(f"Enter price for {item}: "))
+            price = float(ask(f"Enter price for {item}: "))
             menu[item] = price
         accommodation = {}
         while True:
-            type = input("Enter accommodation type (or 'done' to finish): ")
+            type = ask("Enter accommodation type (or 'done' to finish): ")
             if type.lower() == 'done':
                 break
-            price = float(input(f"Enter price for {type}: "))
+            price = float(ask(f"Enter price for {type}: "))
             accommodation[type] = price
-        wealth = input("Enter the wealth level (poor, average, rich): ")
-        local_or_adventure = input("Is it a local or adventure tavern?: ")
-        lodging = input("Enter the type of lodging available: ")
-        patrons = input("Enter patrons (comma separated): ").split(", ")
-        guild_associations = input("Enter guild associations (comma separated): ").split(", ")
+        wealth = ask("Enter the wealth level (poor, average, rich): ")
+        local_or_adventure = ask("Is it a local or adventure tavern?: ")
+        lodging = ask("Enter the type of lodging available: ")
+        patrons = ask("Enter patrons (comma separated): ").split(", ")
+        guild_associations = ask("Enter guild associations (comma separated): ").split(", ")
 
         new_tavern = Tavern(name, town, barkeep, menu, accommodation, wealth, local_or_adventure, lodging, patrons, guild_associations)
-        taverns.append(new_tavern)
-        save_to_file(taverns, "taverns.json")
+        registry.add("taverns", new_tavern)
         print(f"Tavern in {town} has been added successfully.")
     except ValueError as e:
         print(f"Error: {e}. Please try again.")
 
+def print_not_found(message, name, kinds=COLLECTIONS):
+    suggestions = registry.suggest(name, kinds)
+    if suggestions:
+        message += f" Did you mean: {', '.join(suggestions)}?"
+    print(message)
+
+def print_cards(kind, objects):
+    sys.stdout.write("".join(registry.render(kind, obj) + "\n" for obj in objects))
+
 def handle_town_taverns_command(parts):
     town_name = " ".join(parts[:-1])
-    town_taverns = [tavern for tavern in taverns if tavern.town.lower() == town_name.lower()]
+    town_taverns = registry.where("taverns", "town", town_name)
     if town_taverns:
-        for tavern in town_taverns:
-            print(tavern.display_info())
+        print_cards("taverns", town_taverns)
     else:
         print(f"No taverns found in {town_name}.")
 
 def handle_town_wealth_taverns_command(parts):
-    town_name = parts[0]
-    wealth_level = parts[1]
-    town_wealth_taverns = [tavern for tavern in taverns if tavern.town.lower() == town_name.lower() and tavern.wealth.lower() == wealth_level.lower()]
+    town_name = " ".join(parts[:-2])
+    wealth_level = parts[-2]
+    town_wealth_taverns = registry.where("taverns", "town_wealth", town_name, wealth_level)
     if town_wealth_taverns:
-        for tavern in town_wealth_taverns:
-            print(tavern.display_info())
+        print_cards("taverns", town_wealth_taverns)
     else:
         print(f"No {wealth_level} taverns found in {town_name}.")
 
+def handle_all_shops_command():
+    all_shops = registry.all("shops")
+    if all_shops:
+        print_cards("shops", all_shops)
+    else:
+        print("No shops found.")
+
+def handle_town_shops_command(parts):
+    town_name = " ".join(parts[:-1])
+    town_shops = registry.where("shops", "town", town_name)
+    if town_shops:
+        print_cards("shops", town_shops)
+    else:
+        print(f"No shops found in {town_name}.")
+
+PRICE_LIMIT = 50
+
+def price_entries(method, *args, **kwargs):
+    indexes = [registry.index(kind, "prices") for kind in ("shops", "taverns")]
+    return heapq.merge(*(getattr(index, method)(*args, **kwargs) for index in indexes), key=lambda entry: entry[0])
+
+def split_town(parts):
+    lowered = [part.lower() for part in parts]
+    if "in" in lowered:
+        i = len(lowered) - 1 - lowered[::-1].index("in")
+        return parts[:i], " ".join(parts[i + 1:])
+    return parts, None
+
+def print_prices(entries, empty_message):
+    entries = list(entries)
+    if not entries:
+        print(empty_message)
+        return
+    lines = [f"{item}: {price} at {obj.name} ({obj.town})" for price, _, item, obj in entries[:PRICE_LIMIT]]
+    if len(entries) > PRICE_LIMIT:
+        lines.append(f"...and {len(entries) - PRICE_LIMIT} more.")
+    print("\n".join(lines))
+
+def handle_cheapest_command(parts):
+    item_parts, town = split_town(parts[1:])
+    item = " ".join(item_parts)
+    town_key = name_key(town) if town else None
+    entries = sorted(price_entries("cheapest", name_key(item), 5, town_key), key=lambda entry: entry[0])[:5]
+    print_prices(entries, f"Nobody sells {item}{f' in {town}' if town else ''}.")
+
+def handle_items_price_command(parts):
+    price_parts, town = split_town(parts[1:])
+    town_key = name_key(town) if town else None
+    where = f" in {town}" if town else ""
+    try:
+        if len(price_parts) == 2 and price_parts[0].lower() == "under":
+            high = float(price_parts[1])
+            print_prices(price_entries("between", float("-inf"), high, town_key, include_high=False), f"Nothing costs under {price_parts[1]}{where}.")
+        elif len(price_parts) == 4 and price_parts[0].lower() == "between" and price_parts[2].lower() == "and":
+            low, high = float(price_parts[1]), float(price_parts[3])
+            print_prices(price_entries("between", low, high, town_key), f"Nothing costs between {price_parts[1]} and {price_parts[3]}{where}.")
+        else:
+            print("Usage: items under <price> [in <town>] or items between <low> and <high> [in <town>]")
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+
 def display_help():
     help_text = """
 Available commands:
@@ -418,13 +2446,35 @@ Available commands:
   all shops                 List all shops
   all worships              List all worships
   bruh                      Print "bruh"
+  use <campaign>            Switch to another campaign (with --workspace)
+  campaigns                 List the campaigns in the workspace
+  stats                     Show call counts and latencies (with --stats)
   check <stat> <name>       Check a character's stat
+  <skill> check             Find the best character for a skill
+  <character> <stat>        Show a character's ability, skill or saving throw (<ability> st)
+  all <stat>                Show every character's ability, skill or saving throw (<ability> st)
+  all st                    Show every character's saving throws
   <town> shops              List all shops in a town
   <town> taverns            List all taverns in a town
   <town> <wealth> taverns   List all taverns in a town with a specific wealth level
   <worship> followers       List all followers of a worship
-  <character> info          Display character info
-  <god> info                Display god info
+  cheapest <item> [in <town>]
+                            List the five cheapest places selling an item
+  items under <price> [in <town>]
+                            List items cheaper than a price
+  items between <low> and <high> [in <town>]
+                            List items within a price range
+  roll <stat> [for all|<names>] [with advantage|disadvantage]
+                            Roll a check for every character (or the named ones)
+  group <stat> vs dc <dc> [for <names>] [with advantage|disadvantage]
+                            Roll a group check; it passes if at least half succeed
+  odds <stat> vs dc <dc> [for <names>] [with advantage|disadvantage] [simulate <rolls>]
+                            Chance of each character and the group succeeding
+  search <words>            Rank every record whose text mentions the words (or words starting with them)
+  <name> neighbours         List everything directly connected to a name
+  path <name> to <name> [within <steps>]
+                            Shortest chain of connections between two names
+  <name> info               Display a character, god, shop, town, shopkeep or tavern
   <god> search              Search for a god by name
   <god> of <patronage>      Search for a god by patronage
   edit god                  Edit god details
@@ -435,7 +2485,7 @@ Available commands:
 
 def handle_check_command(parts):
     stat, name = parts[1], " ".join(parts[2:])
-    character = next((char for char in characters if char.name.lower() == name.lower()), None)
+    character = registry.find("characters", name)
     if character:
         stat_value = character.get_stat(stat)
         if stat_value is not None:
@@ -443,182 +2493,1029 @@ def handle_check_command(parts):
         else:
             print(f"{name} does not have a stat or skill named {stat}")
     else:
-        print(f"No character named {name} found.")
+        print_not_found(f"No character named {name} found.", name, ["characters"])
 
-def handle_st_command(parts):
-    town_name = " ".join(parts[:-1])
-    print(f"Handling shops/taverns in town: {town_name}")
+def split_stat(parts):
+    for size in (3, 2, 1):
+        if len(parts) > size:
+            stat = " ".join(parts[-size:]).lower()
+            if stat in STAT_POSITIONS:
+                return " ".join(parts[:-size]), stat
+    return None
+
+def handle_best_check_command(parts):
+    stat = " ".join(parts[:-1]).lower()
+    if stat not in STAT_POSITIONS:
+        print(f"There is no stat or skill named {stat}.")
+        return
+    best, value = registry.index("characters", "stats").best(stat)
+    if best:
+        print(f"Best {stat}: {', '.join(character.name for character in best)} ({value})")
+    else:
+        print("No characters found.")
+
+def handle_stat_command(parts):
+    name, stat = split_stat(parts)
+    stats = registry.index("characters", "stats")
+    if name.lower() == "all":
+        column = stats.column(stat)
+        if column:
+            print("\n".join(f"{character.name}: {value}" for character, value in column))
+        else:
+            print("No characters found.")
+        return
+    character = registry.find("characters", name)
+    if character:
+        print(f"{name}'s {stat} is {stats.value(character, stat)}")
+    else:
+        print_not_found(f"No character named {name} found.", name, ["characters"])
+
+def handle_all_saving_throws_command():
+    stats = registry.index("characters", "stats")
+    columns = [(ability, stats.column(f"{ability} st")) for ability in ABILITIES]
+    if not columns[0][1]:
+        print("No characters found.")
+        return
+    for i, (character, value) in enumerate(columns[0][1]):
+        saves = ", ".join(f"{ability} {column[i][1]}" for ability, column in columns)
+        print(f"{character.name}: {saves}")
+
+DICE_MODES = ("advantage", "disadvantage")
+CHANCE_BITS = 16
+SIMULATION_CHUNK = 1 << 20
+
+dice = random.Random(os.environ.get("DMASSIST_DICE_SEED"))
+
+def roll_d20s(count, mode=None):
+    # One draw for the whole party; advantage and disadvantage roll a second die for everyone
+    rolls = dice.choices(range(1, 21), k=count * (2 if mode else 1))
+    if not mode:
+        return [(roll, (roll,)) for roll in rolls]
+    pick = max if mode == "advantage" else min
+    return [(pick(pair), pair) for pair in zip(rolls[::2], rolls[1::2])]
+
+def success_chance(modifier, dc, mode=None):
+    chance = min(20, max(0, 21 - (dc - modifier))) / 20
+    if mode == "advantage":
+        return 1 - (1 - chance) ** 2
+    if mode == "disadvantage":
+        return chance ** 2
+    return chance
+
+def group_needs(size):
+    # A group check passes when at least half the group succeeds
+    return (size + 1) // 2
+
+def group_success_chance(chances):
+    # Poisson-binomial distribution of the number of characters who succeed
+    distribution = [1.0]
+    for chance in chances:
+        distribution = [fail * (1 - chance) + succeed * chance for fail, succeed in zip(distribution + [0.0], [0.0] + distribution)]
+    return sum(distribution[group_needs(len(chances)):])
+
+def bernoulli_bits(chance, trials, mask):
+    # Each of the trials bits is set with the given chance: a uniform CHANCE_BITS-bit number per trial is
+    # compared against the threshold one bit position at a time, least significant first
+    threshold = round(chance * (1 << CHANCE_BITS))
+    if threshold <= 0:
+        return 0
+    if threshold >= 1 << CHANCE_BITS:
+        return mask
+    bits = 0
+    for i in range((threshold & -threshold).bit_length() - 1, CHANCE_BITS):
+        random_bits = dice.getrandbits(trials)
+        bits = (random_bits | bits) if threshold >> i & 1 else (random_bits & bits)
+    return bits
+
+def at_least(planes, need, mask):
+    # planes hold every trial's success count in binary, one bit position per integer
+    if need.bit_length() > len(planes):
+        return 0
+    greater, equal = 0, mask
+    for j in reversed(range(len(planes))):
+        if need >> j & 1:
+            equal &= planes[j]
+        else:
+            greater |= equal & planes[j]
+            equal &= mask ^ planes[j]
+    return greater | equal
+
+def simulate_checks(chances, trials):
+    # Trials are packed one per bit of a Python integer, so each character's rolls for a whole chunk of
+    # trials are drawn and tallied with a handful of big-integer operations
+    need = group_needs(len(chances))
+    successes = [0] * len(chances)
+    group = 0
+    done = 0
+    while done < trials:
+        size = min(SIMULATION_CHUNK, trials - done)
+        mask = (1 << size) - 1
+        planes = []
+        for i, chance in enumerate(chances):
+            carry = bernoulli_bits(chance, size, mask)
+            successes[i] += carry.bit_count()
+            for j in range(len(planes)):
+                if not carry:
+                    break
+                planes[j], carry = planes[j] ^ carry, planes[j] & carry
+            if carry:
+                planes.append(carry)
+        group += at_least(planes, need, mask).bit_count()
+        done += size
+    return [count / trials for count in successes], group / trials
+
+def parse_roll(parts):
+    parts = list(parts[1:])
+    mode = None
+    trials = None
+    while parts:
+        last = parts[-1].lower()
+        if len(parts) > 1 and parts[-2].lower() == "simulate" and last.isdigit():
+            trials = int(last)
+            del parts[-2:]
+        elif last in DICE_MODES:
+            mode = last
+            del parts[-1]
+            if parts and parts[-1].lower() == "with":
+                del parts[-1]
+        else:
+            break
+    names = None
+    lowered = [part.lower() for part in parts]
+    if "for" in lowered:
+        position = lowered.index("for")
+        target = " ".join(parts[position + 1:])
+        if target.lower() != "all":
+            names = [name.strip() for name in target.split(",") if name.strip()]
+        del parts[position:], lowered[position:]
+    dc = None
+    if "vs" in lowered:
+        position = lowered.index("vs")
+        value = [part for part in lowered[position + 1:] if part != "dc"]
+        if len(value) != 1 or not value[0].lstrip("-").isdigit():
+            raise ValueError("Expected a number after vs dc")
+        dc = int(value[0])
+        del parts[position:]
+    stat = " ".join(parts).lower()
+    if stat not in STAT_POSITIONS:
+        raise ValueError(f"There is no stat or skill named {stat}")
+    return stat, dc, names, mode, trials
+
+def party_modifiers(stat, names):
+    stats = registry.index("characters", "stats")
+    if names is None:
+        return stats.column(stat)
+    party = []
+    for name in names:
+        character = registry.find("characters", name)
+        if character is None:
+            raise ValueError(f"No character named {name} found")
+        party.append((character, stats.value(character, stat)))
+    return party
+
+def describe_check(stat, mode, dc=None):
+    return stat + (f" vs DC {dc}" if dc is not None else "") + (f" with {mode}" if mode else "")
+
+def describe_roll(roll, dice_rolled, modifier):
+    rolled = ", ".join(str(die) for die in dice_rolled)
+    return f"{roll + modifier} (rolled {rolled}, {modifier:+d})"
+
+def handle_roll_command(parts):
+    try:
+        stat, dc, names, mode, trials = parse_roll(parts)
+        party = party_modifiers(stat, names)
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+        return
+    if not party:
+        print("No characters found.")
+        return
+    lines = [f"Rolling {describe_check(stat, mode)}:"]
+    for (character, modifier), (roll, dice_rolled) in zip(party, roll_d20s(len(party), mode)):
+        lines.append(f"  {character.name}: {describe_roll(roll, dice_rolled, modifier)}")
+    print("\n".join(lines))
+
+def handle_group_check_command(parts):
+    try:
+        stat, dc, names, mode, trials = parse_roll(parts)
+        if dc is None:
+            raise ValueError("Expected vs dc <number>")
+        party = party_modifiers(stat, names)
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+        return
+    if not party:
+        print("No characters found.")
+        return
+    lines = [f"Group {describe_check(stat, mode, dc)}:"]
+    passed = 0
+    for (character, modifier), (roll, dice_rolled) in zip(party, roll_d20s(len(party), mode)):
+        success = roll + modifier >= dc
+        passed += success
+        lines.append(f"  {character.name}: {describe_roll(roll, dice_rolled, modifier)} - {'pass' if success else 'fail'}")
+    need = group_needs(len(party))
+    lines.append(f"{passed} of {len(party)} succeeded (needs {need}): the group {'succeeds' if passed >= need else 'fails'}.")
+    print("\n".join(lines))
+
+def handle_odds_command(parts):
+    try:
+        stat, dc, names, mode, trials = parse_roll(parts)
+        if dc is None:
+            raise ValueError("Expected vs dc <number>")
+        party = party_modifiers(stat, names)
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+        return
+    if not party:
+        print("No characters found.")
+        return
+    chances = [success_chance(modifier, dc, mode) for character, modifier in party]
+    simulated = None
+    if trials:
+        start = time.perf_counter()
+        simulated, simulated_group = simulate_checks(chances, trials)
+        elapsed = time.perf_counter() - start
+    lines = [f"Chance of success, {describe_check(stat, mode, dc)}:"]
+    for i, ((character, modifier), chance) in enumerate(zip(party, chances)):
+        line = f"  {character.name} ({modifier:+d}): {chance:.1%}"
+        if simulated:
+            line += f" (simulated {simulated[i]:.1%})"
+        lines.append(line)
+    line = f"Group (at least {group_needs(len(party))} of {len(party)}): {group_success_chance(chances):.1%}"
+    if simulated:
+        line += f" (simulated {simulated_group:.1%} over {trials} rolls per character in {elapsed:.2f} s)"
+    lines.append(line)
+    print("\n".join(lines))
 
 def list_all_worships():
     worships = set()
-    for god in gods:
+    for god in registry.all("gods"):
         worships.add(god.name)
     return "\n".join(sorted(worships))
 
-def handle_worship_command(parts):
-    worship = " ".join(parts[:-1])
-    followers = [char.name for char in characters if char.god.lower() == worship.lower()]
+def print_followers(god_name, include_notable=False):
+    followers = registry.followers(god_name, include_notable)
     if followers:
-        print(f"Followers of {worship}: {', '.join(followers)}")
+        print(f"Followers of {god_name}: {', '.join(followers)}")
     else:
-        print(f"No followers of {worship} found.")
+        print(f"No followers of {god_name} found.")
+
+def handle_worship_command(parts):
+    print_followers(" ".join(parts[:-1]))
 
 def handle_god_search_command(parts):
     search_name = " ".join(parts[2:])
-    found_gods = [god for god in gods if search_name.lower() in god.name.lower()]
+    found_gods = registry.where("gods", "name_ngrams", search_name)
     if found_gods:
-        for god in found_gods:
-            print(god.display_info())
+        print_cards("gods", found_gods)
     else:
         print(f"No gods found matching the name {search_name}.")
 
 def handle_god_of_command(parts):
     patronage = " ".join(parts[2:])
-    found_gods = [god for god in gods if patronage.lower() in [p.lower() for p in god.patronage]]
+    found_gods = registry.where("gods", "patronage", patronage)
     if found_gods:
-        for god in found_gods:
-            print(god.display_info())
+        print_cards("gods", found_gods)
     else:
         print(f"No gods found with patronage of {patronage}.")
 
 def handle_followers_command(parts):
-    god_name = " ".join(parts[:-1])
-    followers = [char.name for char in characters if char.god.lower() == god_name.lower()]
-    if followers:
-        print(f"Followers of {god_name}: {', '.join(followers)}")
-    else:
-        print(f"No followers of {god_name} found.")
+    print_followers(" ".join(parts[:-1]), include_notable=True)
 
 def handle_info_command(parts):
     name = " ".join(parts[:-1])
-    character = next((char for char in characters if char.name.lower() == name.lower()), None)
-    god = next((g for g in gods if g.name.lower() == name.lower()), None)
-    if character:
-        print(character.display_info())
-    elif god:
-        print(god.display_info())
+    for kind in COLLECTIONS:
+        found = registry.find(kind, name)
+        if found:
+            print(registry.render(kind, found))
+            return
+    print_not_found(f"No character, god, shop, town, shopkeep or tavern named {name} found.", name)
+
+def handle_use_command(parts):
+    if workspace is None:
+        print("There is only one campaign. Start DM Assist with --workspace <directory> to switch between campaigns.")
+        return
+    try:
+        campaign = workspace.use(" ".join(parts[1:]))
+    except ValueError as e:
+        print(f"Error: {e}. Please try again.")
+        return
+    print(f"Now using {campaign}.")
+
+def handle_campaigns_command():
+    if workspace is None:
+        print("There is only one campaign. Start DM Assist with --workspace <directory> to switch between campaigns.")
+        return
+    current = current_campaign.get() or workspace.default_campaign()
+    resident = set(workspace.registries)
+    lines = []
+    for campaign in workspace.campaigns():
+        notes = [note for note, applies in (("in use", campaign == current), ("loaded", campaign in resident)) if applies]
+        lines.append(campaign + (f" ({', '.join(notes)})" if notes else ""))
+    print("\n".join(lines) if lines else "No campaigns found.")
+
+PATH_DEPTH = 6
+SEARCH_LIMIT = 10
+
+def search_snippet(obj, query, width=80):
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in tokenize(query)) + ")")
+    for text in entity_text(obj):
+        found = pattern.search(text.casefold())
+        if found and text != obj.name:
+            start = max(0, found.start() - width // 3)
+            snippet = text[start:start + width]
+            return ("..." if start else "") + snippet + ("..." if start + width < len(text) else "")
+    return ""
+
+def handle_search_command(parts):
+    query = " ".join(parts[1:])
+    matches = registry.search(query, SEARCH_LIMIT)
+    if not matches:
+        print(f"Nothing matches {query}.")
+        return
+    lines = []
+    for score, kind, obj in matches:
+        line = f"{COLLECTIONS[kind][2].capitalize()}: {obj.name} ({score:.2f})"
+        snippet = search_snippet(obj, query)
+        if snippet:
+            line += f" - {snippet}"
+        lines.append(line)
+    print("\n".join(lines))
+
+def handle_neighbours_command(parts):
+    name = " ".join(parts[:-1])
+    neighbours = registry.neighbours(name)
+    if neighbours:
+        print("\n".join(f"{neighbour} ({', '.join(labels)})" for neighbour, labels in sorted(neighbours)))
     else:
-        print(f"No character or god named {name} found.")
+        print_not_found(f"Nothing is connected to {name}.", name)
+
+def handle_path_command(parts):
+    words = parts[1:]
+    max_depth = PATH_DEPTH
+    if len(words) > 2 and words[-2].lower() == "within" and words[-1].isdigit():
+        max_depth = int(words[-1])
+        words = words[:-2]
+    splits = [i for i, word in enumerate(words) if word.lower() == "to" and 0 < i < len(words) - 1]
+    if not splits:
+        print("Usage: path <name> to <name> [within <steps>]")
+        return
+    # Names may themselves contain "to", so prefer the split where both sides are known
+    graphs = registry.graphs()
+    candidates = [(" ".join(words[:i]), " ".join(words[i + 1:])) for i in splits]
+    known = [(start, goal) for start, goal in candidates
+             if all(any(graph.get(name_key(name)) for graph in graphs) for name in (start, goal))]
+    start, goal = (known or candidates)[0]
+    path = registry.shortest_path(start, goal, max_depth)
+    if path is None:
+        print(f"No connection between {start} and {goal} within {max_depth} step{'s' if max_depth != 1 else ''}.")
+        return
+    steps = []
+    for name, labels in path:
+        steps.append(name)
+        if labels:
+            steps.append(f"-[{', '.join(labels)}]->")
+    print(" ".join(steps))
 
 def handle_edit_god_command():
-    name = input("Enter the name of the god to edit: ")
-    god = next((g for g in gods if g.name.lower() == name.lower()), None)
+    name = ask("Enter the name of the god to edit: ")
+    god = registry.find("gods", name)
     if god:
-        new_name = input(f"Enter new name ({god.name}): ") or god.name
-        new_patronage = input(f"Enter new patronage (comma separated) ({', '.join(god.patronage)}): ").split(", ") or god.patronage
-        new_symbols = input(f"Enter new symbols ({god.symbols}): ") or god.symbols
-        new_notable_followers = input(f"Enter new notable followers (comma separated) ({', '.join(god.notable_followers)}): ").split(", ") or god.notable_followers
-        new_notes = input(f"Enter new notes ({god.notes}): ") or god.notes
-
-        god.name = new_name
-        god.patronage = new_patronage
-        god.symbols = new_symbols
-        god.notable_followers = set(new_notable_followers)
-        god.notes = new_notes
-
-        save_to_file(gods, "gods.json")
+        new_name = ask(f"Enter new name ({god.name}): ") or god.name
+        new_patronage = ask(f"Enter new patronage (comma separated) ({', '.join(god.patronage)}): ").split(", ") or god.patronage
+        new_symbols = ask(f"Enter new symbols ({god.symbols}): ") or god.symbols
+        new_notable_followers = ask(f"Enter new notable followers (comma separated) ({', '.join(god.notable_followers)}): ").split(", ") or god.notable_followers
+        new_notes = ask(f"Enter new notes ({god.notes}): ") or god.notes
+
+        try:
+            registry.update("gods", god,
+                name=new_name,
+                patronage=new_patronage,
+                symbols=new_symbols,
+                notable_followers=set(new_notable_followers),
+                notes=new_notes
+            )
+        except ValueError as e:
+            print(f"Error: {e}. Please try again.")
+            return
         print(f"{god.name} has been updated.")
     else:
-        print(f"No god named {name} found.")
+        print_not_found(f"No god named {name} found.", name, ["gods"])
 
 def handle_edit_character_command():
-    name = input("Enter the name of the character to edit: ")
-    character = next((char for char in characters if char.name.lower() == name.lower()), None)
+    name = ask("Enter the name of the character to edit: ")
+    character = registry.find("characters", name)
     if character:
-        new_name = input(f"Enter new name ({character.name}): ") or character.name
-        new_race = input(f"Enter new race ({character.race}): ") or character.race
-        new_class = input(f"Enter new class ({character.char_class}): ") or character.char_class
-        new_level = int(input(f"Enter new level ({character.level}): ") or character.level)
-        new_subclass = input(f"Enter new subclass ({character.sub_class}): ") or character.sub_class
+        new_name = ask(f"Enter new name ({character.name}): ") or character.name
+        new_race = ask(f"Enter new race ({character.race}): ") or character.race
+        new_class = ask(f"Enter new class ({character.char_class}): ") or character.char_class
+        new_level = int(ask(f"Enter new level ({character.level}): ") or character.level)
+        new_subclass = ask(f"Enter new subclass ({character.sub_class}): ") or character.sub_class
         new_ability_modifiers = character.ability_modifiers
-        for ability in ["strength", "dexterity", "constitution", "intelligence", "wisdom", "charisma"]:
-            new_mod = input(f"Enter new {ability} modifier ({character.ability_modifiers[ability]}): ")
+        for ability in ABILITIES:
+            new_mod = ask(f"Enter new {ability} modifier ({character.ability_modifiers[ability]}): ")
             if new_mod:
                 new_ability_modifiers[ability] = int(new_mod)
-        new_proficiencies = input(f"Enter new proficiencies (comma separated) ({', '.join(character.proficiencies)}): ").split(", ") or character.proficiencies
-        new_saving_throws = input(f"Enter new saving throws (comma separated) ({', '.join(character.saving_throws)}): ").split(", ") or character.saving_throws
+        new_proficiencies = ask(f"Enter new proficiencies (comma separated) ({', '.join(character.proficiencies)}): ").split(", ") or character.proficiencies
+        new_saving_throws = ask(f"Enter new saving throws (comma separated) ({', '.join(character.saving_throws)}): ").split(", ") or character.saving_throws
         new_actions = {
-            "bonus_actions": input(f"Enter new bonus actions ({character.actions['bonus_actions']}): ") or character.actions["bonus_actions"],
-            "extra_attacks": int(input(f"Enter new extra attacks ({character.actions['extra_attacks']}): ") or character.actions["extra_attacks"]),
-            "actions": int(input(f"Enter new actions ({character.actions['actions']}): ") or character.actions["actions"])
+            "bonus_actions": ask(f"Enter new bonus actions ({character.actions['bonus_actions']}): ") or character.actions["bonus_actions"],
+            "extra_attacks": int(ask(f"Enter new extra attacks ({character.actions['extra_attacks']}): ") or character.actions["extra_attacks"]),
+            "actions": int(ask(f"Enter new actions ({character.actions['actions']}): ") or character.actions["actions"])
         }
-        new_god = input(f"Enter new god ({character.god}): ") or character.god
-        new_proficiency_bonus = int(input(f"Enter new proficiency bonus ({character.proficiency_bonus}): ") or character.proficiency_bonus)
-
-        character.name = new_name
-        character.race = new_race
-        character.char_class = new_class
-        character.level = new_level
-        character.sub_class = new_subclass
-        character.ability_modifiers = new_ability_modifiers
-        character.proficiencies = new_proficiencies
-        character.saving_throws = new_saving_throws
-        character.actions = new_actions
-        character.god = new_god
-        character.proficiency_bonus = new_proficiency_bonus
-
-        save_to_file(characters, "characters.json")
+        new_god = ask(f"Enter new god ({character.god}): ") or character.god
+        new_proficiency_bonus = int(ask(f"Enter new proficiency bonus ({character.proficiency_bonus}): ") or character.proficiency_bonus)
+
+        try:
+            registry.update("characters", character,
+                name=new_name,
+                race=new_race,
+                char_class=new_class,
+                level=new_level,
+                sub_class=new_subclass,
+                ability_modifiers=new_ability_modifiers,
+                proficiencies=new_proficiencies,
+                saving_throws=new_saving_throws,
+                actions=new_actions,
+                god=new_god,
+                proficiency_bonus=new_proficiency_bonus
+            )
+        except ValueError as e:
+            print(f"Error: {e}. Please try again.")
+            return
         print(f"{character.name} has been updated.")
     else:
-        print(f"No character named {name} found.")
+        print_not_found(f"No character named {name} found.", name, ["characters"])
+
+class CommandRouter:
+    def __init__(self, commands, cache_size=4096):
+        self.exact = {}
+        self.prefixes = {}
+        self.suffixes = {}
+        for priority, (position, pattern, handler, *min_parts) in enumerate(commands):
+            tokens = tuple(pattern.split())
+            entry = (priority, handler, max(min_parts + [len(tokens)]))
+            if position == "exact":
+                self.exact.setdefault(tokens, entry)
+                continue
+            node = self.prefixes if position == "prefix" else self.suffixes
+            for token in (tokens if position == "prefix" else reversed(tokens)):
+                node = node.setdefault(token, {})
+            node.setdefault(None, entry)
+        self.parse = functools.lru_cache(maxsize=cache_size)(self.match)
+
+    def match(self, user_input):
+        parts = tuple(user_input.split())
+        tokens = tuple(part.lower() for part in parts)
+        best = self.exact.get(tokens)
+        for trie, path in ((self.prefixes, tokens), (self.suffixes, tokens[::-1])):
+            node = trie
+            for token in path:
+                node = node.get(token)
+                if node is None:
+                    break
+                entry = node.get(None)
+                if entry is not None and len(tokens) >= entry[2] and (best is None or entry[0] < best[0]):
+                    best = entry
+        return (best[1] if best else None), parts
+
+def command_table():
+    saving_throws = [stat for stat in STAT_COLUMNS if stat.endswith(" st")]
+    other_stats = [stat for stat in STAT_COLUMNS if not stat.endswith(" st")]
+    return [
+        ("exact", "quit", lambda parts: False),
+        ("exact", "help", lambda parts: display_help()),
+        ("prefix", "check", handle_check_command, 3),
+        ("suffix", "check", handle_best_check_command, 2),
+        # These commands end in a stat, item or campaign name, so they have to win over the stat suffixes below
+        ("prefix", "use", handle_use_command, 2),
+        ("prefix", "cheapest", handle_cheapest_command, 2),
+        ("prefix", "items under", handle_items_price_command, 3),
+        ("prefix", "items between", handle_items_price_command, 5),
+        ("prefix", "roll", handle_roll_command, 2),
+        ("prefix", "group", handle_group_check_command, 4),
+        ("prefix", "odds", handle_odds_command, 4),
+        ("exact", "all st", lambda parts: handle_all_saving_throws_command()),
+        *[("suffix", stat, handle_stat_command, len(stat.split()) + 1) for stat in saving_throws],
+        ("exact", "all worships", lambda parts: print(list_all_worships())),
+        ("suffix", "worship", handle_worship_command, 2),
+        ("prefix", "god search", handle_god_search_command, 3),
+        ("prefix", "god of", handle_god_of_command, 3),
+        ("suffix", "followers", handle_followers_command, 2),
+        ("suffix", "info", handle_info_command, 2),
+        ("suffix", "neighbours", handle_neighbours_command, 2),
+        ("prefix", "search", handle_search_command, 2),
+        ("suffix", "neighbors", handle_neighbours_command, 2),
+        ("prefix", "path", handle_path_command, 4),
+        ("prefix", "edit god", lambda parts: handle_edit_god_command()),
+        ("prefix", "edit character", lambda parts: handle_edit_character_command()),
+        ("exact", "add character", lambda parts: handle_add_character_command()),
+        ("exact", "add god", lambda parts: handle_add_god_command()),
+        ("exact", "add shop", lambda parts: handle_add_shop_command()),
+        ("exact", "add town", lambda parts: handle_add_town_command()),
+        ("exact", "add shopkeep", lambda parts: handle_add_shopkeep_command()),
+        ("exact", "add tavern", lambda parts: handle_add_tavern_command()),
+        ("exact", "all shops", lambda parts: handle_all_shops_command()),
+        ("suffix", "shops", handle_town_shops_command, 2),
+        *[("suffix", f"{wealth} taverns", handle_town_wealth_taverns_command, 3) for wealth in sorted(WEALTH_LEVELS)],
+        ("suffix", "taverns", handle_town_taverns_command, 2),
+        *[("suffix", stat, handle_stat_command, len(stat.split()) + 1) for stat in other_stats],
+        ("exact", "campaigns", lambda parts: handle_campaigns_command()),
+        ("exact", "stats", lambda parts: handle_stats_command()),
+        ("exact", "bruh", lambda parts: print("bruh")),
+    ]
+
+router = CommandRouter(command_table())
 
 def handle_command(user_input):
-    parts = user_input.split()
-
-    if user_input == "quit":
-        return False
-    elif user_input == "help":
-        display_help()
-    elif "check" in user_input:
-        handle_check_command(parts)
-    elif len(parts) >= 3 and parts[-1].lower() == "st":
-        handle_st_command(parts)
-    elif user_input == "all worships":
-        print(list_all_worships())
-    elif len(parts) > 1 and parts[-1].lower() == "worship":
-        handle_worship_command(parts)
-    elif len(parts) > 2 and parts[0].lower() == "god" and parts[1].lower() == "search":
-        handle_god_search_command(parts)
-    elif len(parts) > 2 and parts[0].lower() == "god" and parts[1].lower() == "of":
-        handle_god_of_command(parts)
-    elif len(parts) > 1 and parts[-1].lower() == "followers":
-        handle_followers_command(parts)
-    elif len(parts) > 1 and parts[-1].lower() == "info":
-        handle_info_command(parts)
-    elif user_input.startswith("edit god"):
-        handle_edit_god_command()
-    elif user_input.startswith("edit character"):
-        handle_edit_character_command()
-    elif user_input == "add character":
-        handle_add_character_command()
-    elif user_input == "add god":
-        handle_add_god_command()
-    elif user_input == "add shop":
-        handle_add_shop_command()
-    elif user_input == "add town":
-        handle_add_town_command()
-    elif user_input == "add shopkeep":
-        handle_add_shopkeep_command()
-    elif user_input == "add tavern":
-        handle_add_tavern_command()
-    elif user_input == "all shops":
-        handle_all_shops_command()
-    elif len(parts) > 1 and parts[-1].lower() == "shops":
-        handle_town_shops_command(parts)
-    elif len(parts) > 1 and parts[-1].lower() == "taverns":
-        handle_town_taverns_command(parts)
-    elif len(parts) == 2 and parts[-1].lower() == "taverns":
-        handle_town_wealth_taverns_command(parts)
-    elif user_input == "bruh":
-        print("bruh")
-    else:
+    handler, parts = router.parse(user_input)
+    if handler is None:
         print("Unknown command. Please try again.")
-    
-    return True
+        return True
+    return handler(parts) is not False
+
+LATENCY_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0)
+LATENCY_LABELS = ("<0.1ms", "<1ms", "<10ms", "<100ms", "<1s", ">=1s")
+INSTRUMENTED = ("handle_command", "load_from_file", "save_to_file")
+
+class Instrumentation:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def record(self, name, elapsed):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {"calls": 0, "total": 0.0, "max": 0.0, "histogram": [0] * len(LATENCY_LABELS)}
+            timing["calls"] += 1
+            timing["total"] += elapsed
+            timing["max"] = max(timing["max"], elapsed)
+            timing["histogram"][bisect_right(LATENCY_BUCKETS, elapsed)] += 1
+
+    def wrap(self, name, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return timed
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                name: {
+                    "calls": timing["calls"],
+                    "total_ms": timing["total"] * 1000,
+                    "mean_ms": timing["total"] * 1000 / timing["calls"],
+                    "max_ms": timing["max"] * 1000,
+                    "histogram": dict(zip(LATENCY_LABELS, timing["histogram"])),
+                }
+                for name, timing in self.timings.items()
+            }
+
+    def summary(self):
+        timings = sorted(self.to_dict().items(), key=lambda item: item[1]["total_ms"], reverse=True)
+        if not timings:
+            return "No commands have been timed yet."
+        lines = [f"{'function':<36}{'calls':>8}{'total ms':>11}{'mean ms':>10}{'max ms':>10}" + "".join(f"{label:>8}" for label in LATENCY_LABELS)]
+        for name, timing in timings:
+            lines.append(
+                f"{name:<36}{timing['calls']:>8}{timing['total_ms']:>11.1f}{timing['mean_ms']:>10.3f}{timing['max_ms']:>10.3f}"
+                + "".join(f"{count:>8}" for count in timing["histogram"].values())
+            )
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        with open(filename, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+instrumentation = None
+
+def enable_instrumentation():
+    # Handlers are only wrapped when asked for, so an uninstrumented session pays nothing
+    global instrumentation, router
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+        module = globals()
+        for name in [name for name in module if name.startswith("handle_") or name in INSTRUMENTED]:
+            if callable(module[name]):
+                module[name] = instrumentation.wrap(name, module[name])
+        # The router holds references to the unwrapped handlers, so rebuild it around the wrapped ones
+        router = CommandRouter(command_table())
+    return instrumentation
+
+def handle_stats_command():
+    if instrumentation is None:
+        print("Timing is off. Start DM Assist with --stats or DMASSIST_STATS=1 to record command latencies.")
+    else:
+        print(instrumentation.summary())
+
+def is_write_command(user_input):
+    return user_input.split(" ", 1)[0].lower() in ("add", "edit")
+
+def is_campaign_command(user_input):
+    return user_input.split(" ", 1)[0].lower() == "use"
+
+def capture_command(user_input, campaign=None, seed=None):
+    captured = io.StringIO()
+    token = current_campaign.set(campaign)
+    if seed is not None:
+        dice.seed(seed)
+    try:
+        with contextlib.redirect_stdout(captured):
+            handle_command(user_input)
+    finally:
+        current_campaign.reset(token)
+    return captured.getvalue()
+
+def reset_worker():
+    registry.after_fork()
+    # Forked workers would otherwise all roll the same dice
+    dice.seed()
+
+class ReadPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.seed = os.environ.get("DMASSIST_DICE_SEED")
+        self.tasks = 0
+
+    def publish(self):
+        # Workers are forked from the fully loaded registry, so each one reads a copy-on-write image of it
+        self.close()
+        registry.load()
+        context = multiprocessing.get_context("fork")
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=context, initializer=reset_worker)
+
+    def map(self, commands):
+        if self.executor is None:
+            self.publish()
+        chunksize = max(1, len(commands) // (self.workers * 4))
+        campaigns = [current_campaign.get()] * len(commands)
+        # Which worker runs a command varies from run to run, so with a fixed seed each command gets its own
+        # stream derived from its position in the script; the rolls then repeat whatever the number of workers
+        seeds = [f"{self.seed}:{self.tasks + i}" for i in range(len(commands))] if self.seed is not None else [None] * len(commands)
+        self.tasks += len(commands)
+        return list(self.executor.map(capture_command, commands, campaigns, seeds, chunksize=chunksize))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+def run_batch(stream, output=None, as_json=False, flush_size=1 << 20, pool=None, chunk_size=4096):
+    output = output or sys.stdout
+    pending = []
+    pending_size = 0
+    commands = 0
+    reads = []
+
+    def emit(user_input, text):
+        nonlocal pending, pending_size, commands
+        commands += 1
+        if as_json:
+            text = json.dumps({"command": user_input, "output": text}) + "\n"
+        pending.append(text)
+        pending_size += len(text)
+        if pending_size >= flush_size:
+            output.write("".join(pending))
+            pending = []
+            pending_size = 0
+
+    def run_reads():
+        for user_input, text in zip(reads, pool.map(reads)):
+            emit(user_input, text)
+        reads.clear()
+
+    original_stdin = sys.stdin
+    # add/edit commands read their answers from the lines that follow them in the script
+    sys.stdin = stream
+    prompts = interactive.set(False)
+    try:
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            user_input = line.strip().lower()
+            if not user_input:
+                continue
+            if pool is not None and user_input != "quit" and not is_write_command(user_input) and not is_campaign_command(user_input):
+                reads.append(user_input)
+                if len(reads) >= chunk_size:
+                    run_reads()
+                continue
+            if reads:
+                run_reads()
+            captured = io.StringIO()
+            with contextlib.redirect_stdout(captured):
+                # A failed command is reported in its own output and the script carries on with the next one
+                try:
+                    keep_going = handle_command(user_input)
+                except EOFError:
+                    print("Error: the script ran out of answers for this command.")
+                    keep_going = True
+                except Exception as e:
+                    print(f"Error: {e}.")
+                    keep_going = True
+            emit(user_input, captured.getvalue())
+            if pool is not None and (is_write_command(user_input) or is_campaign_command(user_input)):
+                pool.publish()
+            if not keep_going:
+                break
+        if reads:
+            run_reads()
+    finally:
+        interactive.reset(prompts)
+        sys.stdin = original_stdin
+        output.write("".join(pending))
+        output.flush()
+    return commands
+
+class ThreadOutput(io.TextIOBase):
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer if buffer is not None else self.fallback).write(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.fallback.flush()
+
+def parse_request(line):
+    # A request is a JSON object; a line that is not JSON at all is taken as a bare command
+    text = line.decode()
+    try:
+        request = json.loads(text)
+    except json.JSONDecodeError:
+        return {"command": text.strip()}
+    if not isinstance(request, dict):
+        raise ValueError("a request must be a JSON object or a plain command")
+    if not isinstance(request.get("command", ""), str):
+        raise ValueError("the command must be a string")
+    return request
+
+def run_captured(user_input, answers=None, campaign=None):
+    output = sys.stdout
+    output.local.buffer = io.StringIO()
+    original_stdin = sys.stdin
+    # Pool threads keep their context between tasks, so every request sets its own campaign
+    token = current_campaign.set(campaign)
+    prompts = interactive.set(False)
+    if answers is not None:
+        # Only the single writer thread passes answers, so swapping stdin can't race with a reader.
+        # Writes always get their own stdin, even an empty one, so a prompt can't block on the server's
+        sys.stdin = io.StringIO("".join(f"{answer}\n" for answer in answers))
+    try:
+        handle_command(user_input)
+    except EOFError:
+        # Raised as a failure so the client gets "ok": false rather than a successful-looking error message
+        raise ValueError("not enough answers were sent for this command")
+    finally:
+        current_campaign.reset(token)
+        interactive.reset(prompts)
+        sys.stdin = original_stdin
+        text = output.local.buffer.getvalue()
+        output.local.buffer = None
+    return text
+
+class ReadWriteGate:
+    def __init__(self):
+        self.readers = 0
+        self.writing = False
+        self.condition = asyncio.Condition()
+
+    async def acquire_read(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writing)
+            self.readers += 1
+
+    async def release_read(self):
+        async with self.condition:
+            self.readers -= 1
+            self.condition.notify_all()
+
+    async def acquire_write(self):
+        # The command writer and the file reloader both write, so wait out the other one first;
+        # claiming the gate before the readers drain stops new readers from starving the writer
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writing)
+            self.writing = True
+            await self.condition.wait_for(lambda: self.readers == 0)
+
+    async def release_write(self):
+        async with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+class CommandServer:
+    def __init__(self, readers=8, watcher=None):
+        self.read_executor = ThreadPoolExecutor(max_workers=readers)
+        self.write_executor = ThreadPoolExecutor(max_workers=1)
+        self.watcher = watcher
+        self.gate = None
+        self.writes = None
+
+    async def read(self, user_input, campaign=None):
+        await self.gate.acquire_read()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.read_executor, run_captured, user_input, None, campaign)
+        finally:
+            await self.gate.release_read()
+
+    async def writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            user_input, answers, campaign, result = await self.writes.get()
+            await self.gate.acquire_write()
+            try:
+                output = await loop.run_in_executor(self.write_executor, run_captured, user_input, answers, campaign)
+                result.set_result(output)
+            except Exception as e:
+                result.set_exception(e)
+            finally:
+                await self.gate.release_write()
+
+    async def reloader(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.watcher.interval)
+            if self.watcher.pending:
+                await self.gate.acquire_write()
+                try:
+                    await loop.run_in_executor(self.write_executor, self.watcher.apply)
+                finally:
+                    await self.gate.release_write()
+
+    async def execute(self, user_input, answers=(), campaign=None):
+        if is_write_command(user_input):
+            result = asyncio.get_running_loop().create_future()
+            await self.writes.put((user_input, list(answers), campaign, result))
+            return await result
+        return await self.read(user_input, campaign)
+
+    async def handle_client(self, reader, writer):
+        # Each connection works in its own campaign, chosen with use or per request with "campaign"
+        campaign = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                user_input = ""
+                try:
+                    request = parse_request(line)
+                    user_input = request.get("command", "").strip().lower()
+                    if user_input == "quit":
+                        break
+                    if workspace is not None and is_campaign_command(user_input):
+                        campaign = workspace.resolve(user_input.split(" ", 1)[1] if " " in user_input else "")
+                        output = f"Now using {campaign}.\n"
+                    else:
+                        request_campaign = workspace.resolve(request["campaign"]) if workspace is not None and request.get("campaign") else campaign
+                        output = await self.execute(user_input, request.get("answers", ()), request_campaign)
+                    response = {"command": user_input, "ok": True, "output": output}
+                except Exception as e:
+                    response = {"command": user_input, "ok": False, "output": f"Error: {e}"}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, ready=None):
+        self.gate = ReadWriteGate()
+        self.writes = asyncio.Queue()
+        tasks = [asyncio.create_task(self.writer())]
+        if self.watcher is not None:
+            tasks.append(asyncio.create_task(self.reloader()))
+        server = await asyncio.start_server(self.handle_client, host, port, backlog=4096)
+        print(f"Serving on {host}:{port}", file=sys.stderr)
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+def serve(address, readers=8, watcher=None):
+    host, _, port = address.rpartition(":")
+    original_stdout = sys.stdout
+    sys.stdout = ThreadOutput(original_stdout)
+    try:
+        asyncio.run(CommandServer(readers, watcher).serve(host or "127.0.0.1", int(port)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout = original_stdout
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DM Assist")
+    parser.add_argument("--import-sqlite", metavar="DATABASE", help="copy the JSON files in this directory into a SQLite database and exit")
+    parser.add_argument("--export-sqlite", metavar="DATABASE", help="write the contents of a SQLite database out as JSON files in this directory and exit")
+    parser.add_argument("--prefetch", action="store_true", default=os.environ.get("DMASSIST_PREFETCH") == "1", help="load every collection in the background while waiting for the first command")
+    parser.add_argument("--startup-time", action="store_true", help="report the time taken to reach the first prompt")
+    parser.add_argument("--batch", metavar="FILE", help="run the commands in FILE (or - for stdin) without prompting and exit")
+    parser.add_argument("--json", action="store_true", help="with --batch, write one JSON object per command instead of plain text")
+    parser.add_argument("--workers", type=int, default=0, help="with --batch, answer read-only commands on this many forked worker processes")
+    parser.add_argument("--serve", metavar="HOST:PORT", nargs="?", const="127.0.0.1:8765", help="serve commands as JSON lines over TCP (default 127.0.0.1:8765)")
+    parser.add_argument("--readers", type=int, default=8, help="with --serve, the number of threads answering read-only commands")
+    parser.add_argument("--watch", action="store_true", default=os.environ.get("DMASSIST_WATCH") == "1", help="reload JSON files edited by other programs while running")
+    parser.add_argument("--watch-interval", type=float, default=float(os.environ.get("DMASSIST_WATCH_INTERVAL", 1.0)), help="seconds between checks for edited files")
+    parser.add_argument("--workspace", metavar="DIRECTORY", default=os.environ.get("DMASSIST_WORKSPACE"), help="serve every campaign in a subdirectory of DIRECTORY (switch with use <campaign>)")
+    parser.add_argument("--campaign", default=os.environ.get("DMASSIST_CAMPAIGN"), help="with --workspace, the campaign to start in (default: the first one)")
+    parser.add_argument("--resident", type=int, default=int(os.environ.get("DMASSIST_RESIDENT", 4)), help="with --workspace, how many campaigns to keep loaded at once")
+    parser.add_argument("--stats", action="store_true", default=os.environ.get("DMASSIST_STATS") == "1", help="time every command and file load/save (see the stats command)")
+    parser.add_argument("--stats-file", metavar="FILE", default=os.environ.get("DMASSIST_STATS_FILE"), help="write the timings as JSON to FILE on quit (implies --stats)")
+    parser.add_argument("--profile", metavar="FILE", default=os.environ.get("DMASSIST_PROFILE"), help="record a cProfile of the session to FILE")
+    args = parser.parse_args(argv)
+
+    if args.import_sqlite:
+        database = SqliteRegistry(args.import_sqlite)
+        database.load()
+        source = Registry()
+        source.load()
+        database.import_from(source)
+        print(f"Imported JSON files into {args.import_sqlite}.")
+        return
+    if args.export_sqlite:
+        database = SqliteRegistry(args.export_sqlite)
+        database.load()
+        database.export_to(".")
+        print(f"Exported {args.export_sqlite} to JSON files.")
+        return
+
+    if args.stats or args.stats_file:
+        enable_instrumentation()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        run_session(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats_file:
+            instrumentation.dump(args.stats_file)
+        # Closing folds journals into the JSON and re-snapshots whatever this session changed
+        if workspace is not None:
+            workspace.close()
+        else:
+            registry.close()
+
+def run_session(args):
+    watcher = None
+    if args.workspace:
+        watch_interval = args.watch_interval if args.watch and (args.serve or not args.batch) else None
+        try:
+            enable_workspace(args.workspace, args.resident, os.environ.get("DMASSIST_STORAGE", "json"), args.campaign, watch_interval)
+        except ValueError as e:
+            print(f"Error: {e}.", file=sys.stderr)
+            return
+        if watch_interval is not None:
+            # The workspace applies the reloads of whichever campaigns are loaded
+            watcher = workspace
+    elif args.watch and (args.serve or not args.batch):
+        if isinstance(registry, SqliteRegistry):
+            print("Warning: --watch only applies to JSON storage.", file=sys.stderr)
+        else:
+            watcher = FileWatcher(registry, args.watch_interval)
+            watcher.start()
+
+    if args.serve:
+        serve(args.serve, args.readers, watcher)
+        return
+
+    if args.batch:
+        pool = ReadPool(args.workers) if args.workers else None
+        try:
+            if args.batch == "-":
+                run_batch(sys.stdin, as_json=args.json, pool=pool)
+            else:
+                with open(args.batch, "r") as script:
+                    run_batch(script, as_json=args.json, pool=pool)
+        finally:
+            if pool is not None:
+                pool.close()
+        return
 
-def main():
+    if args.prefetch:
+        registry.prefetch()
+    if args.startup_time:
+        print(f"Time to first prompt: {(time.perf_counter() - STARTED_AT) * 1000:.1f} ms")
     while True:
         user_input = input("What would you like to do? (type help for a list of commands): ").lower()
+        if watcher is not None:
+            watcher.apply()
         if not handle_command(user_input):
             break
 
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import random
+
+import dmAssist
+
+RACES = ["Human", "Elf", "Dwarf", "Halfling", "Dragon Born", "Tiefling", "Gnome", "Half-Orc"]
+CLASSES = ["Barbarian", "Bard", "Cleric", "Druid", "Fighter", "Monk", "Paladin", "Ranger", "Rogue", "Sorcerer", "Warlock", "Wizard"]
+SKILLS = ["athletics", "acrobatics", "stealth", "arcana", "history", "insight", "perception", "survival", "deception", "persuasion"]
+SHOP_TYPES = ["smith", "general", "apothecary", "tailor", "jeweller", "fletcher", "bookshop", "stables"]
+ITEMS = ["Sword", "Dagger", "Shield", "Longbow", "Arrows", "Rope", "Torch", "Lantern", "Rations", "Healing Potion",
+         "Cloak", "Boots", "Spellbook", "Ink", "Saddle", "Ring", "Lute", "Chain Mail", "Tent", "Bedroll"]
+MENU = ["ale", "mead", "wine", "stew", "bread", "roast", "pie", "cheese"]
+ROOMS = ["common room", "private room", "suite", "stable"]
+GUILDS = ["Merchants", "Thieves", "Mages", "Smiths", "Farmers", "Sailors", "Miners", "Scribes", "Hunters", "Masons"]
+LODGING = ["inn", "hostel", "none"]
+
+SCALES = {
+    "small": {"characters": 100, "gods": 50, "towns": 10, "shops": 1000, "taverns": 1000},
+    "medium": {"characters": 1000, "gods": 500, "towns": 100, "shops": 10000, "taverns": 10000},
+    "large": {"characters": 10000, "gods": 5000, "towns": 1000, "shops": 50000, "taverns": 50000},
+}
+
+def kind_random(seed, kind):
+    # Each kind gets its own stream so changing one count doesn't reshuffle the others
+    return random.Random(f"{seed}:{kind}")
+
+def reference(rng, prefix, count):
+    # A link to a random record of another kind, left empty when that kind has none
+    return f"{prefix} {rng.randrange(count)}" if count else ""
+
+def references(rng, prefix, count, size):
+    return [reference(rng, prefix, count) for _ in range(size)] if count else []
+
+def prices(rng, names, count, low, high):
+    return {name: round(rng.uniform(low, high), 1) for name in rng.sample(names, count)}
+
+def generate_characters(counts, seed=0):
+    rng = kind_random(seed, "characters")
+    for i in range(counts["characters"]):
+        yield {
+            "name": f"Character {i}",
+            "race": rng.choice(RACES),
+            "char_class": rng.choice(CLASSES),
+            "level": rng.randint(1, 20),
+            "sub_class": "",
+            "ability_modifiers": {ability: rng.randint(-1, 5) for ability in dmAssist.ABILITIES},
+            "proficiencies": rng.sample(SKILLS, 3),
+            "actions": {"bonus_actions": False, "extra_attacks": 0, "actions": 1},
+            "god": reference(rng, "God", counts["gods"]),
+            "proficiency_bonus": 2,
+            "saving_throws": rng.sample(dmAssist.ABILITIES, 2),
+        }
+
+def generate_gods(counts, seed=0):
+    rng = kind_random(seed, "gods")
+    for i in range(counts["gods"]):
+        yield {
+            "name": f"God {i}",
+            "patronage": [f"Aspect {rng.randrange(counts['gods'] * 2)}" for _ in range(3)],
+            "symbols": "A symbol",
+            "notable_followers": references(rng, "Character", counts["characters"], 1),
+            "notes": "",
+        }
+
+def generate_towns(counts, seed=0):
+    rng = kind_random(seed, "towns")
+    for i in range(counts["towns"]):
+        yield {
+            "name": f"Town {i}",
+            "mayor": f"Mayor {i}",
+            "important_guilds": rng.sample(GUILDS, 2),
+            "patron_gods": references(rng, "God", counts["gods"], 1),
+        }
+
+def generate_shops(counts, seed=0):
+    rng = kind_random(seed, "shops")
+    for i in range(counts["shops"]):
+        yield {
+            "name": f"Shop {i}",
+            "town": reference(rng, "Town", counts["towns"]),
+            "type": rng.choice(SHOP_TYPES),
+            "shopkeep": f"Shopkeep {i}",
+            "inventory": prices(rng, ITEMS, 5, 0.5, 500),
+        }
+
+def generate_shopkeeps(counts, seed=0):
+    # One shopkeep per shop, living in the shop's town
+    shop_towns = (shop["town"] for shop in generate_shops(counts, seed))
+    rng = kind_random(seed, "shopkeeps")
+    for i, town in enumerate(shop_towns):
+        yield {
+            "name": f"Shopkeep {i}",
+            "town": town,
+            "shop": f"Shop {i}",
+            "relationships": references(rng, "Shopkeep", counts["shops"], 1),
+            "notes": "",
+        }
+
+def generate_taverns(counts, seed=0):
+    rng = kind_random(seed, "taverns")
+    for i in range(counts["taverns"]):
+        yield {
+            "name": f"Tavern {i}",
+            "town": reference(rng, "Town", counts["towns"]),
+            "barkeep": f"Barkeep {i}",
+            "menu": prices(rng, MENU, 4, 0.1, 5),
+            "accommodation": prices(rng, ROOMS, 2, 0.5, 20),
+            "wealth": rng.choice(sorted(dmAssist.WEALTH_LEVELS)),
+            "local_or_adventure": rng.choice(["local", "adventure"]),
+            "lodging": rng.choice(LODGING),
+            "patrons": references(rng, "Character", counts["characters"], 2),
+            "guild_associations": rng.sample(GUILDS, 1),
+        }
+
+GENERATORS = {
+    "characters": generate_characters,
+    "gods": generate_gods,
+    "shops": generate_shops,
+    "towns": generate_towns,
+    "shopkeeps": generate_shopkeeps,
+    "taverns": generate_taverns,
+}
+
+def generate_campaign(directory, counts, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    for kind, (filename, cls, label) in dmAssist.COLLECTIONS.items():
+        objects = (cls.from_dict(data) for data in GENERATORS[kind](counts, seed))
+        dmAssist.save_to_file(objects, os.path.join(directory, filename))
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic DM Assist campaign")
+    parser.add_argument("directory")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small", help="preset sizes, overridden by the options below")
+    for kind in dmAssist.COLLECTIONS:
+        if kind != "shopkeeps":
+            parser.add_argument(f"--{kind}", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    counts = dict(SCALES[args.scale])
+    counts.update({kind: getattr(args, kind) for kind in counts if getattr(args, kind) is not None})
+    generate_campaign(args.directory, counts, args.seed)
+    print(f"Wrote {', '.join(f'{count} {kind}' for kind, count in counts.items())} to {args.directory}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import unittest
+
+import dmAssist
+
+class RouterTest(unittest.TestCase):
+    def route(self, user_input):
+        return dmAssist.router.parse(user_input)[0]
+
+    def test_use_campaign_named_after_a_stat(self):
+        for campaign in ("history", "insight", "arcana", "strength", "dexterity st"):
+            self.assertIs(self.route(f"use {campaign}"), dmAssist.handle_use_command)
+
+    def test_stat_and_roll_commands(self):
+        self.assertIs(self.route("spike history"), dmAssist.handle_stat_command)
+        self.assertIs(self.route("spike dexterity st"), dmAssist.handle_stat_command)
+        self.assertIs(self.route("roll perception"), dmAssist.handle_roll_command)
+        self.assertIs(self.route("cheapest potion of perception"), dmAssist.handle_cheapest_command)
+
+if __name__ == "__main__":
+    unittest.main()